@@ -0,0 +1,104 @@
+"""
+compare img_compress.compress modes on synthetic midjourney-like 2x2 grids
+
+    python -m benchmark.bench_compress [--repeat 5]
+"""
+import argparse
+import io
+import random
+import statistics
+import time
+
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageStat
+
+from src import img_compress
+
+SIZES = (1024, 2048, 4096)
+SOURCE_FORMATS = ("PNG", "JPEG")
+
+
+def make_grid(side, seed=0):
+    rnd = random.Random(seed)
+    tile = side // 2
+    grid = Image.new("RGB", (side, side))
+    for ti in range(4):
+        img = Image.linear_gradient("L").resize((tile, tile)).convert("RGB")
+        img = ImageChops.multiply(img, Image.new("RGB", (tile, tile), tuple(rnd.randint(80, 255) for _ in range(3))))
+        draw = ImageDraw.Draw(img)
+        for _ in range(60):
+            x0, y0 = rnd.randrange(tile), rnd.randrange(tile)
+            r = rnd.randint(tile // 64, tile // 6)
+            draw.ellipse((x0 - r, y0 - r, x0 + r, y0 + r), fill=tuple(rnd.randrange(256) for _ in range(3)))
+        for _ in range(120):
+            x0, y0 = rnd.randrange(tile), rnd.randrange(tile)
+            draw.line((x0, y0, rnd.randrange(tile), rnd.randrange(tile)),
+                      fill=tuple(rnd.randrange(256) for _ in range(3)), width=rnd.randint(1, 4))
+        noise = Image.effect_noise((tile, tile), 24).convert("RGB")
+        img = ImageChops.add(img.filter(ImageFilter.GaussianBlur(1)), noise, scale=1.0, offset=-24)
+        grid.paste(img, ((ti % 2) * tile, (ti // 2) * tile))
+    return grid
+
+
+def encode_source(img, fmt):
+    bs = io.BytesIO()
+    img.save(bs, format=fmt, quality=95)
+    return bs.getvalue()
+
+
+def ssim(a, b, window=64):
+    """mean SSIM over non overlapping windows of the luma channel, computed with ImageStat only"""
+    a, b = a.convert("L"), b.convert("L")
+    if a.size != b.size:
+        b = b.resize(a.size, Image.LANCZOS)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    scores = []
+    width, height = a.size
+    for top in range(0, height - window + 1, window):
+        for left in range(0, width - window + 1, window):
+            box = (left, top, left + window, top + window)
+            wa, wb = a.crop(box), b.crop(box)
+            sa, sb = ImageStat.Stat(wa), ImageStat.Stat(wb)
+            mu_a, mu_b = sa.mean[0], sb.mean[0]
+            var_a, var_b = sa.var[0], sb.var[0]
+            # var((a + b) / 2) = (var_a + var_b + 2 * cov) / 4
+            var_mid = ImageStat.Stat(ImageChops.add(wa, wb, scale=2.0)).var[0]
+            cov = 2 * var_mid - (var_a + var_b) / 2
+            scores.append(((2 * mu_a * mu_b + c1) * (2 * cov + c2)) /
+                          ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2)))
+    return sum(scores) / len(scores) if scores else 1.0
+
+
+def bench(src_bs, mode, repeat):
+    times = []
+    out = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = img_compress.compress_bytes(src_bs, mode)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'size':>6} {'source':>6} {'mode':>9} {'ms':>9} {'speedup':>8} {'bytes':>9} {'ssim':>7}")
+    for side in SIZES:
+        grid = make_grid(side)
+        for fmt in SOURCE_FORMATS:
+            src_bs = encode_source(grid, fmt)
+            baseline_time, baseline_out = bench(src_bs, "quality", args.repeat)
+            reference = Image.open(io.BytesIO(baseline_out))
+            for mode in img_compress.COMPRESS_MODES:
+                if mode == "quality":
+                    cost, out = baseline_time, baseline_out
+                else:
+                    cost, out = bench(src_bs, mode, args.repeat)
+                quality = ssim(reference, Image.open(io.BytesIO(out)))
+                print(f"{side:>6} {fmt:>6} {mode:>9} {cost * 1000:>9.1f} {baseline_time / cost:>7.2f}x "
+                      f"{len(out):>9} {quality:>7.4f}")
+
+
+if __name__ == '__main__':
+    main()
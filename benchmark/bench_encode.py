@@ -0,0 +1,86 @@
+"""
+bytes and encode time of the output encoding strategies on a 1024x1024 grid, opaque and with alpha
+
+    python -m benchmark.bench_encode [--target 200000 --repeat 5]
+"""
+import argparse
+import io
+import statistics
+import time
+
+from PIL import Image
+
+from benchmark.bench_compress import make_grid, ssim
+from src import img_compress
+
+
+def legacy_encode(img):
+    """the encoding compress() did before, png for RGBA and jpeg quality 60 for everything else"""
+    bs = io.BytesIO()
+    if img.mode == "RGBA":
+        img.save(bs, format="PNG", quality=60)
+    else:
+        img.convert("RGB").save(bs, format="JPEG", quality=60)
+    return bs.getvalue()
+
+
+def with_alpha(img):
+    alpha = Image.radial_gradient("L").resize(img.size).point(lambda _v: 255 - _v)
+    img = img.copy()
+    img.putalpha(alpha)
+    return img
+
+
+def strategies(target):
+    def adaptive(fmt):
+        def run(img):
+            return img_compress.encode(img_compress._flatten(img, fmt), fmt, target)
+        return run
+
+    return [
+        ("legacy", legacy_encode),
+        ("jpeg60", lambda img: img_compress.encode(img_compress._flatten(img, "JPEG"), "JPEG")),
+        ("jpeg-target", adaptive("JPEG")),
+        ("webp-target", adaptive("WEBP")),
+    ]
+
+
+def reference(img):
+    # what the viewer sees, transparent pixels over the white chat background
+    return img_compress._flatten(img, "JPEG")
+
+
+def bench(encode, img, repeat):
+    img_compress._quality_cache.clear()
+    start = time.perf_counter()
+    out = encode(img)
+    cold = time.perf_counter() - start
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = encode(img)
+        times.append(time.perf_counter() - start)
+    return cold, statistics.median(times), out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", type=int, default=200 * 1024)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    grid = make_grid(1024)
+    print(f"target {args.target} bytes")
+    print(f"{'source':>6} {'strategy':>12} {'bytes':>9} {'base64':>9} {'cold ms':>8} {'warm ms':>8} {'ssim':>6}")
+    for source_name, img in (("RGB", grid), ("RGBA", with_alpha(grid))):
+        ref = reference(img)
+        for name, encode in strategies(args.target):
+            cold, warm, out = bench(encode, img, args.repeat)
+            score = ssim(ref, reference(Image.open(io.BytesIO(out))))
+            b64 = (len(out) + 2) // 3 * 4
+            print(f"{source_name:>6} {name:>12} {len(out):>9} {b64:>9} {cold * 1000:>8.1f} {warm * 1000:>8.1f} "
+                  f"{score:>6.3f}")
+
+
+if __name__ == '__main__':
+    main()
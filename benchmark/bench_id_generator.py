@@ -0,0 +1,128 @@
+"""
+job id codec and job registry lookups: ids/sec of the id_generator encode/decode compared with the codec it
+replaced (string prepending and alphabet.index), and JobRegistry put/get per second
+
+    python -m benchmark.bench_id_generator [--ids 100000 --long 2000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from src import id_generator
+from src.job_registry import JobRecord, JobRegistry
+
+
+def legacy_bytes_to_52(b):
+    alphabet = id_generator.alphabet
+    base = len(alphabet)
+    n = int.from_bytes(b, byteorder='big', signed=False)
+    res = ""
+    while n > 0:
+        n, r = divmod(n, base)
+        res = alphabet[r] + res
+    return res
+
+
+def legacy_s52_to_bytes(s):
+    alphabet = id_generator.alphabet
+    base = len(alphabet)
+    n = 0
+    for c in s:
+        n = n * base + alphabet.index(c)
+    return n.to_bytes((n.bit_length() + 7) // 8, byteorder='big', signed=False)
+
+
+def legacy_encode(string):
+    flag = "0"
+    process_str = string
+    try:
+        process_str = "{:x}".format(int(string))
+        flag = "1"
+    except ValueError:
+        pass
+    return legacy_bytes_to_52((flag + process_str).encode("utf-8")[::-1])
+
+
+def legacy_decode(string):
+    try:
+        bs_str = legacy_s52_to_bytes(string)[::-1].decode("utf-8")
+        flag, process_str = bs_str[0], bs_str[1:]
+        if flag == "0":
+            return process_str
+        if flag == "1":
+            return str(int(f"0x{process_str}", 16))
+        return None
+    except:
+        return None
+
+
+def best_of(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def compare(name, values, repeat):
+    encoded = [legacy_encode(_v) for _v in values]
+    assert [id_generator.encode(_v) for _v in values] == encoded, f"{name}: encode differs from the legacy codec"
+    assert [id_generator.decode(_e) for _e in encoded] == [legacy_decode(_e) for _e in encoded] == values, \
+        f"{name}: decode does not round trip"
+    rows = [
+        ("legacy encode", lambda: [legacy_encode(_v) for _v in values]),
+        ("encode", lambda: [id_generator.encode(_v) for _v in values]),
+        ("legacy decode", lambda: [legacy_decode(_e) for _e in encoded]),
+        ("decode", lambda: [id_generator.decode(_e) for _e in encoded]),
+    ]
+    print(f"{name}: {len(values)} ids, {sum(map(len, encoded)) / len(encoded):.0f} chars each")
+    for label, func in rows:
+        print(f"  {label:>14} {len(values) / best_of(func, repeat):>12,.0f} ids/sec")
+
+
+def bench_registry(count, repeat):
+    rnd = random.Random(0)
+    records = []
+    for idx in range(count):
+        image_id = str(rnd.randrange(10 ** 12, 10 ** 13))
+        records.append(JobRecord(id_generator.encode(image_id), image_id, f"room{idx % 50}", f"user{idx % 500}",
+                                 "mj", "一只白猫", "a white cat", f"https://example.com/{image_id}.png",
+                                 ["upsample1", "upsample2", "upsample3", "upsample4"], time.time(), time.time()))
+    with tempfile.TemporaryDirectory() as tmp:
+        for path in (":memory:", os.path.join(tmp, "registry.sqlite3")):
+            job_registry = JobRegistry(path)
+            start = time.perf_counter()
+            for record in records:
+                job_registry.put(record)
+            put_cost = time.perf_counter() - start
+            job_ids = [_r.job_id for _r in records]
+            rnd.shuffle(job_ids)
+            get_cost = best_of(lambda: [job_registry.get(_j) for _j in job_ids], repeat)
+            assert job_registry.get(records[0].job_id) == records[0]
+            print(f"registry {'memory' if path == ':memory:' else 'file':>6} put {count / put_cost:>10,.0f}/sec  "
+                  f"get {count / get_cost:>10,.0f}/sec")
+            job_registry.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ids", type=int, default=100000)
+    parser.add_argument("--long", type=int, default=2000, help="length of the strings in the long id run")
+    parser.add_argument("--registry", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    compare("midjourney image ids", [str(rnd.randrange(10 ** 12, 10 ** 19)) for _ in range(args.ids)], args.repeat)
+    alphabet = "abcdefghijklmnopqrstuvwxyz0123456789-"
+    compare("long string ids", ["".join(rnd.choice(alphabet) for _ in range(args.long)) for _ in range(100)],
+            args.repeat)
+    bench_registry(args.registry, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""
+end to end load test of MidjourneyBot: a fake puppet feeds on_message with group traffic from many rooms and
+users while translation, midjourney and the image downloads go to the local fake upstream. Reports
+messages/sec, jobs/sec, per stage latency percentiles, event loop lag and peak RSS
+
+    python -m benchmark.bench_load [--rooms 20 --users 200 --messages 5000 --rate 200 \\
+        --mix chatter=0.9,mj=0.05,u=0.02,v=0.02,p=0.01 --mj-latency lognormal:3,0.4] [-config_key value ...]
+
+any bot config key can be appended in its usual -key value form, e.g. -scheduler_max_running 16
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import sys
+import time
+
+from benchmark.bench_parser import BOT_NAME, CHATTER, MEMBERS, PROMPTS, SEPARATOR
+from benchmark.fake_zhishuyun import FakeZhiShuYun, latency
+from src import Config, id_generator, metrics
+from src.command_parser import CommandParser, tip1, tip2, tip3
+
+MIX_KINDS = ("chatter", "mj", "u", "v", "p")
+
+
+class FakeContact:
+    def __init__(self, contact_id):
+        self.contact_id = contact_id
+
+
+class FakeRoom:
+    """
+    records what the bot says, every say takes say_latency like a round trip to the puppet service
+    """
+
+    def __init__(self, room_id, say_latency, rnd):
+        self.room_id = room_id
+        self._say_latency = say_latency
+        self._rnd = rnd
+        self.texts = 0
+        self.files = 0
+        self.results = 0
+        self.previews = 0
+
+    async def say(self, content, mention_ids=None):
+        await asyncio.sleep(self._say_latency(self._rnd))
+        if isinstance(content, str):
+            self.texts += 1
+            self.results += content.count(tip1)
+        else:
+            self.files += 1
+            # previews are named after their tile, IMAGE3.jpg
+            self.previews += content.name[5:6].isdigit()
+
+
+class FakeMessage:
+    def __init__(self, room, talker, text):
+        self._room = room
+        self._talker = talker
+        self._text = text
+
+    def room(self):
+        return self._room
+
+    def talker(self):
+        return self._talker
+
+    def text(self):
+        return self._text
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in MIX_KINDS:
+            raise ValueError(f"unknown message kind {kind}, expected one of {MIX_KINDS}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def make_text(kind, rnd, base_url):
+    if kind == "chatter":
+        return rnd.choice(CHATTER).format(member=rnd.choice(MEMBERS))
+    if kind == "mj":
+        return f"@{BOT_NAME} /mj {rnd.choice(PROMPTS)} {rnd.randrange(10 ** 6)}"
+    # the fake upstream accepts any image id, quoting a made up result is as good as quoting a real one
+    image_id = str(rnd.randrange(10 ** 12, 10 ** 13))
+    result = f"@{rnd.choice(MEMBERS)} {tip1}（35秒）\n{tip2} {id_generator.encode(image_id)}\n" \
+             f"{tip3} {base_url}/images/{image_id}.png"
+    return f"「{BOT_NAME}：{result}」{SEPARATOR}@{BOT_NAME} /{kind}{rnd.randint(1, 4)}"
+
+
+class StageSamples:
+    """
+    raw samples of metrics.stage_seconds, its buckets are too coarse for comparing runs
+    """
+
+    def __init__(self):
+        self.samples = {}
+        self._observe = metrics.stage_seconds.observe
+
+    def __enter__(self):
+        def observe(value, **labels):
+            self.samples.setdefault(labels.get("stage", ""), []).append(value)
+            self._observe(value, **labels)
+
+        metrics.stage_seconds.observe = observe
+        return self
+
+    def __exit__(self, *exc):
+        metrics.stage_seconds.observe = self._observe
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def workers_peak_rss_kb(pool):
+    """
+    summed VmHWM of the live compress workers, RUSAGE_CHILDREN only covers children that were already reaped
+    """
+    executor = pool._executor
+    total = 0
+    for pid in (executor._processes if executor is not None else {}):
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+async def watch_loop_lag(lags, interval=0.05):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run(args, config):
+    # the bot is never started, the puppet service only has to look configured
+    os.environ.setdefault("WECHATY_PUPPET_SERVICE_ENDPOINT", "127.0.0.1:1")
+    from src.midjourney_bot import MidjourneyBot
+
+    server = FakeZhiShuYun(gpt_latency=args.gpt_latency, mj_latency=args.mj_latency,
+                           image_latency=args.image_latency, error_rate=args.error_rate,
+                           image_size=args.image_size, image_format=args.image_format, seed=args.seed)
+    await server.start()
+    config.zhishuyun_base_url = server.base_url
+    config.zhishuyun_chatgpt_35_token = config.zhishuyun_chatgpt_35_token or "fake-token"
+    config.zhishuyun_midjourney_token = config.zhishuyun_midjourney_token or "fake-token"
+
+    rnd = random.Random(args.seed)
+    say_latency = latency(args.say_latency)
+    rooms = {f"room{_i}": FakeRoom(f"room{_i}", say_latency, rnd) for _i in range(args.rooms)}
+    users = [FakeContact(f"user{_i}") for _i in range(args.users)]
+    mix = parse_mix(args.mix)
+    kinds = rnd.choices(list(mix), weights=list(mix.values()), k=args.messages)
+    messages = [(kind, FakeMessage(rnd.choice(list(rooms.values())), rnd.choice(users),
+                                   make_text(kind, rnd, server.base_url))) for kind in kinds]
+
+    bot = MidjourneyBot(config)
+    bot.Room = type("FakeRoomLoader", (), {"load": staticmethod(lambda _room_id: rooms[_room_id])})
+    bot.bot_name = BOT_NAME
+    bot._parser = CommandParser(BOT_NAME)
+    await bot._runner.open()
+
+    lags = []
+    lag_task = asyncio.get_running_loop().create_task(watch_loop_lag(lags))
+    jobs = []
+    with StageSamples() as stages:
+        start = time.perf_counter()
+        for idx, (kind, msg) in enumerate(messages):
+            if args.rate > 0:
+                delay = start + idx / args.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            task = asyncio.get_running_loop().create_task(bot.on_message(msg))
+            if kind != "chatter":
+                jobs.append(task)
+            else:
+                # chatter never awaits anything, it is done by the time the loop comes back
+                await task
+        ingest_cost = time.perf_counter() - start
+        done, pending = await asyncio.wait(jobs, timeout=args.drain_timeout) if jobs else (set(), set())
+        # the last messages of a job may still be in the room queues
+        while bot._sender._workers and time.perf_counter() - start < ingest_cost + args.drain_timeout:
+            await asyncio.sleep(0.05)
+        total_cost = time.perf_counter() - start
+    lag_task.cancel()
+    for task in pending:
+        task.cancel()
+
+    results = sum(_r.results for _r in rooms.values())
+    previews = sum(_r.previews for _r in rooms.values())
+    files = sum(_r.files for _r in rooms.values())
+    print(f"{args.messages} messages ({', '.join(f'{_k} {kinds.count(_k)}' for _k in mix)}) over {args.rooms} rooms "
+          f"and {args.users} users, offered rate {args.rate or 'unlimited'}/s")
+    print(f"messages/sec {args.messages / ingest_cost:>10,.1f}   (ingest {ingest_cost:.2f}s)")
+    print(f"jobs/sec     {(results + previews) / total_cost:>10,.2f}   ({results} results and {previews} previews of "
+          f"{len(jobs)} commands in {total_cost:.2f}s, {files} images, "
+          f"{bot._scheduler.stats['rejected']} rejected as busy, {len(pending)} timed out)")
+    print(f"{'stage':>12} {'count':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for stage, values in sorted(stages.samples.items()):
+        print(f"{stage:>12} {len(values):>7} {percentile(values, 50):>8.3f} {percentile(values, 95):>8.3f} "
+              f"{percentile(values, 99):>8.3f} {max(values):>8.3f}")
+    print(f"loop lag     p50 {percentile(lags, 50) * 1000:.1f}ms p99 {percentile(lags, 99) * 1000:.1f}ms "
+          f"max {max(lags, default=0) * 1000:.1f}ms")
+    print(f"peak rss     bot {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}MB, "
+          f"compress workers {workers_peak_rss_kb(bot._runner._compress_pool) / 1024:.0f}MB")
+    print(f"upstream     {server.stats}")
+    print(f"scheduler    {bot._scheduler.stats}")
+    print(f"room sender  {bot._sender.stats}")
+
+    await bot._shutdown()
+    bot.close()
+    await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--rate", type=float, default=200, help="offered messages/sec, 0 sends as fast as possible")
+    parser.add_argument("--mix", default="chatter=0.9,mj=0.05,u=0.02,v=0.02,p=0.01")
+    parser.add_argument("--gpt-latency", default="normal:1,0.3")
+    parser.add_argument("--mj-latency", default="lognormal:3,0.4")
+    parser.add_argument("--image-latency", default="fixed:0.05")
+    parser.add_argument("--say-latency", default="fixed:0.05")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--image-size", type=int, default=2048)
+    parser.add_argument("--image-format", default="PNG")
+    parser.add_argument("--drain-timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    args, config_args = parser.parse_known_args()
+    # what is left are bot config keys, Config reads them from the command line
+    if "-log_level" not in config_args:
+        # one info line per job step would be what the benchmark measures
+        config_args += ["-log_level", "WARNING"]
+    if "-job_registry_path" not in config_args:
+        # a benchmark run leaves no results file behind
+        config_args += ["-job_registry_path", ":memory:"]
+    sys.argv = sys.argv[:1] + config_args
+    logging.getLogger("FileBox").setLevel(logging.WARNING)
+    config = Config()
+    asyncio.run(run(args, config))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+run the same batch of jobs against the local fake upstream in blocking, poll and poll + callback mode
+
+    python -m benchmark.bench_midjourney_poll [--jobs 50 --mj-latency lognormal:3,0.3]
+"""
+import argparse
+import asyncio
+import time
+
+from benchmark.fake_zhishuyun import FakeZhiShuYun
+from src.http_pool import HttpPool
+from src.zsy_midjourney import MidjourneyCallbackServer, ZhiShuYunMidjourney
+
+CALLBACK_PORT = 8091
+
+
+async def run_mode(mode, args):
+    server = FakeZhiShuYun(mj_latency=args.mj_latency, error_rate=args.error_rate)
+    await server.start()
+    http = HttpPool()
+    # poll mode needs a callback url to get task ids, in plain poll mode nothing listens on it
+    callback_url = f"http://127.0.0.1:{CALLBACK_PORT}/midjourney/callback" if mode != "blocking" else None
+    client = ZhiShuYunMidjourney("fake-token", http, server.base_url, "blocking" if mode == "blocking" else "poll",
+                                 callback_url, args.poll_interval)
+    callback_server = None
+    if mode == "callback":
+        callback_server = MidjourneyCallbackServer(client.poller, host="127.0.0.1", port=CALLBACK_PORT)
+        await callback_server.start()
+    start = time.perf_counter()
+    results = await asyncio.gather(*[client.run1("generate", f"prompt {_i}") for _i in range(args.jobs)])
+    cost = time.perf_counter() - start
+    ok = sum(1 for _status, _ in results if _status)
+    print(f"{mode:>9} {cost:>8.2f}s ok {ok:>4}/{args.jobs} upstream requests "
+          f"{server.stats['imagine'] + server.stats['tasks']:>5} peak open upstream requests "
+          f"{server.stats['max_open_requests']:>4} client connections {http.stats['connections_created']:>4} "
+          f"poller {client.poller.stats if client.poller else '-'}")
+    if callback_server is not None:
+        await callback_server.stop()
+    await http.close()
+    await server.stop()
+
+
+async def main(args):
+    for mode in ("blocking", "poll", "callback"):
+        await run_mode(mode, args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=50)
+    parser.add_argument("--mj-latency", default="lognormal:3,0.3")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,161 @@
+"""
+messages/sec of the command parser over synthetic wechat group traffic, compared with the parsing that
+on_message used to do inline, both parsers must agree on every message
+
+    python -m benchmark.bench_parser [--messages 200000 --addressed 0.03]
+"""
+import argparse
+import random
+import time
+
+from src import id_generator
+from src.command_parser import Command, CommandParser, short2command, tip1, tip2
+
+BOT_NAME = "小智同学"
+MEMBERS = ["张三", "李四", "王五", "Alice", "Bob", "阿强", "小美", "老王"]
+CHATTER = [
+    "哈哈哈哈", "今天中午吃什么", "收到", "好的👌", "[图片]", "明天几点开会？", "这个怎么弄啊",
+    "刚看到，稍等我看一下", "周末一起去爬山吗", "笑死我了", "@{member} 你看下这个", "666",
+    "有没有人知道这个报错怎么解决\nTraceback (most recent call last):\n  File \"main.py\"",
+    "转发一下：https://mp.weixin.qq.com/s/abcdefg", "[捂脸][捂脸]", "晚安",
+]
+PROMPTS = ["一只白猫", "赛博朋克风格的城市夜景，霓虹灯", "a cute corgi astronaut --ar 16:9 --v 5",
+           "水墨画 山水 仙鹤", "portrait of an old fisherman, cinematic lighting"]
+SEPARATOR = "\n- - - - - - - - - - - - - - -\n"
+
+
+def bot_result(rnd):
+    job_id = id_generator.encode(str(rnd.randrange(10 ** 12, 10 ** 13)))
+    return f"@{rnd.choice(MEMBERS)} {tip1}（35秒）\n{tip2} {job_id}\n原图片地址: https://example.com/x.png"
+
+
+def make_corpus(size, addressed, seed=0):
+    rnd = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        roll = rnd.random()
+        if roll < addressed * 0.5:
+            corpus.append(f"@{BOT_NAME} /mj {rnd.choice(PROMPTS)}")
+        elif roll < addressed:
+            short = rnd.choice(list(short2command))
+            corpus.append(f"「{BOT_NAME}：{bot_result(rnd)}」{SEPARATOR}@{BOT_NAME} /{short}{rnd.randint(1, 4)}")
+        elif roll < addressed + 0.05:
+            # people quoting each other
+            corpus.append(f"「{rnd.choice(MEMBERS)}：{rnd.choice(CHATTER)}」{SEPARATOR}{rnd.choice(CHATTER)}")
+        elif roll < addressed + 0.07:
+            corpus.append(f"@{BOT_NAME} {rnd.choice(CHATTER)}")
+        else:
+            corpus.append(rnd.choice(CHATTER).format(member=rnd.choice(MEMBERS)))
+    return corpus
+
+
+def _split_first(text, s):
+    idx = text.find(s)
+    if idx < 0:
+        return None, None
+    return text[0:idx].strip(), text[idx + len(s):].strip()
+
+
+def _parse_quote(text):
+    quote_all, left = _split_first(text, "\n- -")
+    if quote_all is None or left is None:
+        return text, None, None
+    left, new_text = _split_first(left, "- -\n")
+    if left is None or new_text is None:
+        return text, None, None
+    if len(left) > 0:
+        for ci, cc in enumerate(left):
+            if ci % 2 == 0:
+                if cc != "-":
+                    return text, None, None
+            else:
+                if cc != " ":
+                    return text, None, None
+    if quote_all.startswith('"') or quote_all.startswith("「"):
+        quote_all = quote_all[1:]
+    if quote_all.endswith('"') or quote_all.endswith("」"):
+        quote_all = quote_all[:-1]
+    quote_from, quote_context = _split_first(quote_all.replace("：", ":"), ":")
+    if quote_from is None or quote_context is None:
+        return text, None, None
+    return new_text, quote_from, quote_context
+
+
+def legacy_parse(text, bot_name):
+    """the parsing on_message did before CommandParser, kept here as the baseline"""
+    text = text.strip()
+    text, quote_from, quote_content = _parse_quote(text)
+    if not text.startswith(f"@{bot_name}"):
+        return None
+    command_text = text[len(bot_name) + 1:].strip()
+    if not command_text.startswith("/"):
+        return None
+    command, args_text = _split_first(command_text[1:], " ")
+    if command is None or args_text is None:
+        command = command_text[1:]
+        args_text = ""
+    command_idx = None
+    try:
+        command = Command(command)
+    except ValueError:
+        try:
+            command, command_idx = short2command.get(command[:-1]), int(command[-1])
+        except (ValueError, IndexError):
+            return None
+        if command is None:
+            return None
+    quote_job_id = None
+    if quote_from is not None:
+        if quote_from != bot_name:
+            return None
+        if not quote_content.startswith("@"):
+            return None
+        at_some, response = _split_first(quote_content, " ")
+        if at_some is None or response is None or len(at_some) < 2:
+            return None
+        quote_lines = response.splitlines()
+        if len(quote_lines) < 2 or not quote_lines[0].strip().startswith(tip1) or \
+                not quote_lines[1].strip().startswith(tip2):
+            return None
+        _, quote_job_id = _split_first(quote_lines[1], ":")
+        if quote_job_id is None:
+            return None
+    return command, command_idx, args_text, quote_job_id
+
+
+def run(name, parse, corpus, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in corpus:
+            parse(text)
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    print(f"{name:>8} {len(corpus) / best:>12,.0f} messages/sec")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--addressed", type=float, default=0.03)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.messages, args.addressed)
+    command_parser = CommandParser(BOT_NAME)
+    accepted = 0
+    for text in corpus:
+        new = command_parser.parse(text)
+        old = legacy_parse(text, BOT_NAME)
+        # the legacy parser never read the image url of the quote
+        assert (tuple(new)[:4] if new is not None else None) == old, (text, new, old)
+        accepted += new is not None
+    print(f"{len(corpus)} messages, {accepted} commands, parsers agree on all of them")
+    before = run("before", lambda _text: legacy_parse(_text, BOT_NAME), corpus, args.repeat)
+    after = run("after", command_parser.parse, corpus, args.repeat)
+    print(f"speedup {before / after:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
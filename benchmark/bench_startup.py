@@ -0,0 +1,104 @@
+"""
+startup time of the bot: import time of the src modules and the time from `python main.py` to the first
+on_scan, against a local stand-in for the wechaty puppet service that answers start/stop and sends a scan
+event as soon as the event stream is opened
+
+    python -m benchmark.bench_startup [--runs 5]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from grpclib.const import Cardinality, Handler
+from grpclib.server import Server
+from wechaty_grpc.wechaty import puppet
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCAN_LOG = "Scan QR Code to login"
+
+
+class FakePuppetService:
+    def __init__(self):
+        self.events = 0
+
+    def __mapping__(self):
+        return {
+            "/wechaty.Puppet/Start": Handler(self._start, Cardinality.UNARY_UNARY, puppet.StartRequest,
+                                             puppet.StartResponse),
+            "/wechaty.Puppet/Stop": Handler(self._stop, Cardinality.UNARY_UNARY, puppet.StopRequest,
+                                            puppet.StopResponse),
+            "/wechaty.Puppet/Event": Handler(self._event, Cardinality.UNARY_STREAM, puppet.EventRequest,
+                                             puppet.EventResponse),
+        }
+
+    async def _start(self, stream):
+        await stream.recv_message()
+        await stream.send_message(puppet.StartResponse())
+
+    async def _stop(self, stream):
+        await stream.recv_message()
+        await stream.send_message(puppet.StopResponse())
+
+    async def _event(self, stream):
+        await stream.recv_message()
+        self.events += 1
+        await stream.send_message(puppet.EventResponse(
+            type=puppet.EventType.EVENT_TYPE_SCAN, payload=json.dumps({"status": 2, "qrcode": "fake-qrcode"})))
+        # keep the stream open like the real service until the bot goes away
+        await asyncio.sleep(3600)
+
+
+def import_time(module):
+    code = f"import time; _t = time.perf_counter(); import {module}; print(time.perf_counter() - _t)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=dict(os.environ, PYTHONPATH=ROOT),
+                         capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+async def time_to_scan(port):
+    env = dict(os.environ, PYTHONPATH=ROOT, WECHATY_PUPPET_SERVICE_ENDPOINT=f"127.0.0.1:{port}",
+               WECHATY_PUPPET_SERVICE_TOKEN="fake-token", ZHISHUYUN_CHATGPT_35_TOKEN="fake-token",
+               ZHISHUYUN_MIDJOURNEY_TOKEN="fake-token")
+    start = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(sys.executable, "main.py", cwd=ROOT, env=env,
+                                                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    try:
+        while True:
+            line = await asyncio.wait_for(proc.stderr.readline(), timeout=60)
+            if not line:
+                raise RuntimeError(f"main.py exited with {await proc.wait()} before on_scan")
+            if SCAN_LOG in line.decode("utf-8", "replace"):
+                return time.perf_counter() - start
+    finally:
+        proc.kill()
+        await proc.wait()
+
+
+async def main(args):
+    service = FakePuppetService()
+    server = Server([service])
+    await server.start("127.0.0.1", 0)
+    port = server._server.sockets[0].getsockname()[1]
+    try:
+        for module in args.modules:
+            costs = [import_time(module) for _ in range(args.runs)]
+            print(f"import {module:<20} median {statistics.median(costs) * 1000:>7.0f}ms  "
+                  f"min {min(costs) * 1000:>7.0f}ms")
+        costs = [await time_to_scan(port) for _ in range(args.runs)]
+        print(f"main.py to first on_scan    median {statistics.median(costs) * 1000:>7.0f}ms  "
+              f"min {min(costs) * 1000:>7.0f}ms  ({args.runs} runs)")
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--modules", nargs="*", default=["src", "src.midjourney_bot", "src.job_worker"])
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,225 @@
+"""
+local stand-in for api.zhishuyun.com, emulates /chatgpt, /midjourney/imagine (blocking and callback_url mode),
+/midjourney/tasks retrieve and serves the generated grid images
+
+    python -m benchmark.fake_zhishuyun --port 8090 --mj-latency lognormal:20,0.4 --error-rate 0.02
+
+then point the bot at it with -zhishuyun_base_url http://127.0.0.1:8090
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import logging
+import math
+import random
+import re
+import time
+
+from aiohttp import ClientSession, web
+from PIL import Image, ImageDraw
+
+log = logging.getLogger(__name__)
+
+_question_re = re.compile(r'我的第一句话是："(.*)"。请立刻翻译', re.S)
+_batch_re = re.compile(r"^([0-9]+)\. (.*)$", re.M)
+
+
+def latency(spec):
+    """
+    fixed:1.5, uniform:1,3, normal:2,0.5, lognormal:20,0.4 (median seconds, sigma)
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(_v) for _v in args.split(",")] if args else []
+    if kind == "fixed":
+        return lambda rnd: values[0]
+    if kind == "uniform":
+        return lambda rnd: rnd.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda rnd: max(0.0, rnd.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda rnd: rnd.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"unknown latency spec {spec}")
+
+
+def make_image(side, fmt="PNG", seed=0):
+    rnd = random.Random(seed)
+    img = Image.new("RGB", (side, side))
+    draw = ImageDraw.Draw(img)
+    half = side // 2
+    for ti in range(4):
+        left, top = (ti % 2) * half, (ti // 2) * half
+        draw.rectangle((left, top, left + half, top + half), fill=tuple(rnd.randrange(256) for _ in range(3)))
+        for _ in range(40):
+            x0, y0 = left + rnd.randrange(half), top + rnd.randrange(half)
+            r = rnd.randint(4, half // 6)
+            draw.ellipse((x0 - r, y0 - r, x0 + r, y0 + r), fill=tuple(rnd.randrange(256) for _ in range(3)))
+    bs = io.BytesIO()
+    img.save(bs, format=fmt)
+    return bs.getvalue()
+
+
+class FakeZhiShuYun:
+    def __init__(self, host="127.0.0.1", port=0, gpt_latency="normal:1,0.3", mj_latency="lognormal:20,0.4",
+                 image_latency="fixed:0.05", error_rate=0.0, image_size=2048, image_format="PNG", seed=0):
+        self._host = host
+        self._port = port
+        self._gpt_latency = latency(gpt_latency)
+        self._mj_latency = latency(mj_latency)
+        self._image_latency = latency(image_latency)
+        self._error_rate = error_rate
+        self._image_size = image_size
+        self._image_format = image_format
+        self._rnd = random.Random(seed)
+        self._ids = itertools.count(1000)
+        self._tasks = {}
+        self._images = {}
+        self._runner = None
+        self._session = None
+        self._open = 0
+        self.stats = {"chatgpt": 0, "chatgpt_batched": 0, "imagine": 0, "tasks": 0, "images": 0, "callbacks": 0, "errors": 0,
+                      "open_requests": 0, "max_open_requests": 0}
+
+    @property
+    def base_url(self):
+        return f"http://{self._host}:{self._port}"
+
+    async def start(self):
+        app = web.Application(middlewares=[self._track])
+        app.router.add_post("/chatgpt", self._chatgpt)
+        app.router.add_post("/midjourney/imagine", self._imagine)
+        app.router.add_post("/midjourney/tasks", self._retrieve)
+        app.router.add_get("/images/{name}", self._image)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self._host, self._port)
+        await site.start()
+        self._port = site._server.sockets[0].getsockname()[1]
+        self._session = ClientSession()
+        log.info(f"FakeZhiShuYun listening on {self.base_url}")
+
+    async def stop(self):
+        if self._session is not None:
+            await self._session.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    @web.middleware
+    async def _track(self, request, handler):
+        self._open += 1
+        self.stats["open_requests"] = self._open
+        self.stats["max_open_requests"] = max(self.stats["max_open_requests"], self._open)
+        try:
+            return await handler(request)
+        finally:
+            self._open -= 1
+            self.stats["open_requests"] = self._open
+
+    def _fail(self):
+        if self._rnd.random() >= self._error_rate:
+            return None
+        self.stats["errors"] += 1
+        return web.json_response({"detail": "fake upstream error"}, status=self._rnd.choice((429, 500, 502)))
+
+    async def _chatgpt(self, request):
+        self.stats["chatgpt"] += 1
+        body = await request.json()
+        await asyncio.sleep(self._gpt_latency(self._rnd))
+        failed = self._fail()
+        if failed is not None:
+            return failed
+        question = body.get("question", "")
+        matched = _question_re.search(question)
+        if matched is None and "编号" in question:
+            self.stats["chatgpt_batched"] += 1
+            return web.json_response({"answer": "\n".join(f"{_idx}. EN {_prompt}"
+                                                           for _idx, _prompt in _batch_re.findall(question))})
+        prompt = matched.group(1) if matched else question
+        return web.json_response({"answer": f"EN {prompt}"})
+
+    def _result(self, action, image_id):
+        new_id = str(next(self._ids))
+        if action.startswith("upsample"):
+            actions = ["variation_subtle", "variation_strong", "zoom_out_2x", "zoom_out_1_5x"]
+        else:
+            actions = ["upsample1", "upsample2", "upsample3", "upsample4",
+                       "variation1", "variation2", "variation3", "variation4"]
+        return {"image_id": new_id, "image_url": f"{self.base_url}/images/{new_id}.png", "actions": actions,
+                "task_id": None, "success": True}
+
+    async def _imagine(self, request):
+        self.stats["imagine"] += 1
+        body = await request.json()
+        failed = self._fail()
+        if failed is not None:
+            return failed
+        cost = self._mj_latency(self._rnd)
+        # like the real upstream, only a callback_url turns the submit into an async task
+        if not body.get("callback_url"):
+            await asyncio.sleep(cost)
+            return web.json_response(self._result(body.get("action", "generate"), body.get("image_id")))
+        task_id = f"task-{next(self._ids)}"
+        self._tasks[task_id] = {"id": task_id, "done_at": time.monotonic() + cost, "response": None}
+        asyncio.get_running_loop().create_task(self._finish(task_id, body, cost))
+        return web.json_response({"task_id": task_id})
+
+    async def _finish(self, task_id, body, cost):
+        await asyncio.sleep(cost)
+        response = self._result(body.get("action", "generate"), body.get("image_id"))
+        response["task_id"] = task_id
+        self._tasks[task_id]["response"] = response
+        if body.get("callback_url"):
+            self.stats["callbacks"] += 1
+            try:
+                async with self._session.post(body["callback_url"], json={"id": task_id, "response": response}):
+                    pass
+            except:
+                log.warning(f"FakeZhiShuYun callback to {body['callback_url']} fail")
+
+    async def _retrieve(self, request):
+        self.stats["tasks"] += 1
+        body = await request.json()
+        task = self._tasks.get(body.get("id"))
+        if task is None:
+            return web.json_response({"detail": "task not found"}, status=404)
+        return web.json_response({"id": task["id"], "response": task["response"] or {}})
+
+    async def _image(self, request):
+        self.stats["images"] += 1
+        await asyncio.sleep(self._image_latency(self._rnd))
+        # every job gets the same picture, generating a fresh grid per request would dominate the benchmark
+        key = (self._image_size, self._image_format)
+        if key not in self._images:
+            self._images[key] = make_image(self._image_size, self._image_format)
+        return web.Response(body=self._images[key], content_type=f"image/{self._image_format.lower()}")
+
+
+async def _serve(args):
+    server = FakeZhiShuYun(args.host, args.port, args.gpt_latency, args.mj_latency, args.image_latency,
+                           args.error_rate, args.image_size, args.image_format)
+    await server.start()
+    try:
+        while True:
+            await asyncio.sleep(60)
+            log.info(f"FakeZhiShuYun stats {server.stats}")
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--gpt-latency", default="normal:1,0.3")
+    parser.add_argument("--mj-latency", default="lognormal:20,0.4")
+    parser.add_argument("--image-latency", default="fixed:0.05")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--image-size", type=int, default=2048)
+    parser.add_argument("--image-format", default="PNG")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve(args))
+
+
+if __name__ == '__main__':
+    main()
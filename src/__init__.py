@@ -1,9 +1,24 @@
 import asyncio
 
 from src.config import Config
-from src.midjourney_bot import MidjourneyBot
 
 
 def run():
-    bot = MidjourneyBot(Config())
-    asyncio.run(bot.start())
+    config = Config()
+    # only the modules of the selected run mode are imported, a worker never loads wechaty
+    if config.run_mode == "worker":
+        from src.job_worker import JobWorker
+
+        worker = JobWorker(config)
+        try:
+            asyncio.run(worker.run())
+        finally:
+            worker.close()
+        return
+    from src.midjourney_bot import MidjourneyBot
+
+    bot = MidjourneyBot(config)
+    try:
+        asyncio.run(bot.start())
+    finally:
+        bot.close()
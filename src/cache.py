@@ -0,0 +1,262 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import traceback
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+_MISSING = object()
+# result of a shared load whose caller was cancelled, the callers that joined it load again
+_ABANDONED = object()
+
+
+def _store_key(key):
+    if isinstance(key, str):
+        return key
+    return json.dumps(key, ensure_ascii=False)
+
+
+class SqliteStore:
+    def __init__(self, path, table="cache", ttl=None):
+        self._table = table
+        self._ttl = ttl
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                           f"(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)")
+        self._conn.commit()
+
+    def get(self, key):
+        row = self._conn.execute(f"SELECT value, created FROM {self._table} WHERE key = ?",
+                                 (_store_key(key),)).fetchone()
+        if row is None:
+            return _MISSING
+        value, created = row
+        if self._ttl is not None and time.time() - created > self._ttl:
+            self.delete(key)
+            return _MISSING
+        return json.loads(value)
+
+    def put(self, key, value):
+        self._conn.execute(f"INSERT OR REPLACE INTO {self._table} (key, value, created) VALUES (?, ?, ?)",
+                           (_store_key(key), json.dumps(value, ensure_ascii=False), time.time()))
+        self._conn.commit()
+
+    def delete(self, key):
+        self._conn.execute(f"DELETE FROM {self._table} WHERE key = ?", (_store_key(key),))
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+class DirStore:
+    """
+    bytes values spilled to files in one directory, least recently used files are removed over max_bytes and
+    files older than ttl since they were written are not served. Sizes and the use order are kept in memory,
+    the directory is only scanned once when the store opens
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, ttl=None):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        os.makedirs(path, exist_ok=True)
+        # file name -> (size, written), least recently used first, files of a previous run in write order
+        self._index = OrderedDict()
+        entries = []
+        for entry in os.scandir(path):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for written, name, size in sorted(entries):
+            self._index[name] = (size, written)
+        self._total = sum(_size for _size, _ in self._index.values())
+
+    def _name(self, key):
+        return hashlib.sha1(_store_key(key).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        name = self._name(key)
+        entry = self._index.get(name)
+        if entry is None:
+            return _MISSING
+        if self._ttl is not None and time.time() - entry[1] > self._ttl:
+            self._remove(name)
+            return _MISSING
+        try:
+            with open(os.path.join(self._path, name), "rb") as f:
+                value = f.read()
+        except FileNotFoundError:
+            self._forget(name)
+            return _MISSING
+        self._index.move_to_end(name)
+        return value
+
+    def put(self, key, value):
+        name = self._name(key)
+        path = os.path.join(self._path, name)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+        self._forget(name)
+        self._index[name] = (len(value), time.time())
+        self._total += len(value)
+        while self._total > self._max_bytes and self._index:
+            self._remove(next(iter(self._index)))
+
+    def delete(self, key):
+        self._remove(self._name(key))
+
+    def _forget(self, name):
+        entry = self._index.pop(name, None)
+        if entry is not None:
+            self._total -= entry[0]
+
+    def _remove(self, name):
+        self._forget(name)
+        try:
+            os.remove(os.path.join(self._path, name))
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        pass
+
+
+class AsyncLRUCache:
+    def __init__(self, max_entries=1024, ttl=None, store=None, max_bytes=None, sizeof=None):
+        """
+        bounded by max_entries, and by max_bytes as measured by sizeof(value) when both are given
+        """
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._store = store
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "store_hits": 0, "evictions": 0,
+                      "bytes": 0, "bytes_saved": 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit_ratio(self):
+        served = self.stats["hits"] + self.stats["coalesced"] + self.stats["store_hits"]
+        total = served + self.stats["misses"]
+        if total == 0:
+            return 0.0
+        return served / total
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expire_at, value = entry
+        if expire_at is not None and expire_at < time.monotonic():
+            self._pop(key)
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        size = self._sizeof(value) if self._sizeof is not None else 0
+        if self._max_bytes is not None and size > self._max_bytes:
+            return
+        if key in self._entries:
+            self._pop(key)
+        expire_at = time.monotonic() + self._ttl if self._ttl is not None else None
+        self._entries[key] = (expire_at, value)
+        self._bytes += size
+        while len(self._entries) > self._max_entries or \
+                (self._max_bytes is not None and self._bytes > self._max_bytes):
+            self._pop(next(iter(self._entries)))
+            self.stats["evictions"] += 1
+        self.stats["bytes"] = self._bytes
+
+    def _pop(self, key):
+        _, value = self._entries.pop(key)
+        if self._sizeof is not None:
+            self._bytes -= self._sizeof(value)
+            self.stats["bytes"] = self._bytes
+
+    def _saved(self, value):
+        if self._sizeof is not None:
+            self.stats["bytes_saved"] += self._sizeof(value)
+
+    async def get_or_load(self, key, loader):
+        """
+        loader is a coroutine function returning (status, value) like the ZhiShuYun clients,
+        only successful results are cached, concurrent callers of the same key share one load and take it
+        over when the caller running it is cancelled
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            self.stats["hits"] += 1
+            self._saved(value)
+            return True, value
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.stats["coalesced"] += 1
+            result = await asyncio.shield(fut)
+            if result is _ABANDONED:
+                return await self.get_or_load(key, loader)
+            if result[0]:
+                self._saved(result[1])
+            return result
+        if self._store is not None:
+            value = self._load_from_store(key)
+            if value is not _MISSING:
+                self.stats["store_hits"] += 1
+                self._saved(value)
+                self.put(key, value)
+                return True, value
+        self.stats["misses"] += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            result = await loader()
+        except asyncio.CancelledError:
+            fut.set_result(_ABANDONED)
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            # mark retrieved, the caller below re-raises it anyway
+            fut.exception()
+            raise
+        else:
+            status, value = result
+            if status:
+                self.put(key, value)
+                self._save_to_store(key, value)
+            fut.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def _load_from_store(self, key):
+        try:
+            return self._store.get(key)
+        except:
+            log.error(f"AsyncLRUCache load {key!r} from store fail\n{traceback.format_exc()}")
+            return _MISSING
+
+    def _save_to_store(self, key, value):
+        if self._store is None:
+            return
+        try:
+            self._store.put(key, value)
+        except:
+            log.error(f"AsyncLRUCache save {key!r} to store fail\n{traceback.format_exc()}")
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
@@ -0,0 +1,101 @@
+import re
+from enum import Enum
+from typing import NamedTuple, Optional
+
+
+class Command(Enum):
+    help = "help"
+    generate = "mj"
+    upsample = "upsample"
+    variation = "variation"
+    upsample_light = "upsample_light"
+    upsample_beta = "upsample_beta"
+    preview = "preview"
+
+
+action_commands = {Command.generate, Command.upsample, Command.variation, Command.upsample_light, Command.upsample_beta}
+
+short2command = {
+    "u": Command.upsample,
+    "v": Command.variation,
+    "p": Command.preview,
+}
+
+tip1 = "✅绘制成功"
+tip2 = "📎任务ID:"
+tip3 = "原图片地址:"
+
+# 「quote」\n- - - - - - - -\ntext, the separator line is an alternation of "-" and " "
+_quote_re = re.compile(r"(?P<quote>.*?)\n- -(?P<separator>.*?)- -\n(?P<text>.*)", re.S)
+_separator_re = re.compile(r"(?:-(?: -)*)?")
+# @someone ✅绘制成功...\n📎任务ID: xxx\n原图片地址: url
+_quote_content_re = re.compile(r"@[^ ]+ \s*" + re.escape(tip1) + r"[^\n]*\n[ \t]*" + re.escape(tip2) +
+                               r"(?P<job_id>[^\n]*)(?:\n[ \t]*" + re.escape(tip3) + r"\s*(?P<image_url>[^\s]+))?")
+_short_re = re.compile(r"(?P<short>" + "|".join(re.escape(_s) for _s in short2command) + r")(?P<idx>[0-9])")
+
+
+class ParsedCommand(NamedTuple):
+    command: Command
+    command_idx: Optional[int]
+    args_text: str
+    quote_job_id: Optional[str]
+    quote_image_url: Optional[str]
+
+
+class CommandParser:
+    """
+    parses "@bot /command args", optionally quoting one of the bot's own result messages, in a single pass,
+    messages that are neither addressed to the bot nor quote it are rejected by a prefix check
+    """
+
+    def __init__(self, bot_name):
+        self._bot_name = bot_name
+        self._mention = f"@{bot_name}"
+        # a message is either addressed to the bot or quotes one of its messages, optionally inside 「」 or ""
+        self._prefixes = (self._mention, bot_name, f"「{bot_name}", f'"{bot_name}', "「 ", '" ')
+        self._command_re = re.compile(re.escape(self._mention) + r"\s*/(?P<command>[^ ]*)(?: +(?P<args>.*))?", re.S)
+
+    def parse(self, text: str) -> Optional[ParsedCommand]:
+        text = text.strip()
+        if not text.startswith(self._prefixes):
+            return None
+        quote_job_id = None
+        quote_image_url = None
+        matched = _quote_re.match(text)
+        if matched is not None and _separator_re.fullmatch(matched.group("separator").strip()):
+            quote_from, quote_content = self._split_quote(matched.group("quote").strip())
+            if quote_from is not None:
+                if quote_from != self._bot_name:
+                    return None
+                quote_matched = _quote_content_re.match(quote_content)
+                if quote_matched is None:
+                    return None
+                quote_job_id = quote_matched.group("job_id").strip()
+                quote_image_url = quote_matched.group("image_url")
+                text = matched.group("text").strip()
+
+        matched = self._command_re.fullmatch(text)
+        if matched is None:
+            return None
+        command_str = matched.group("command").strip()
+        args_text = (matched.group("args") or "").strip()
+        command_idx = None
+        try:
+            command = Command(command_str)
+        except ValueError:
+            short_matched = _short_re.fullmatch(command_str)
+            if short_matched is None:
+                return None
+            command, command_idx = short2command[short_matched.group("short")], int(short_matched.group("idx"))
+        return ParsedCommand(command, command_idx, args_text, quote_job_id, quote_image_url)
+
+    @staticmethod
+    def _split_quote(quote_all):
+        if quote_all.startswith('"') or quote_all.startswith("「"):
+            quote_all = quote_all[1:]
+        if quote_all.endswith('"') or quote_all.endswith("」"):
+            quote_all = quote_all[:-1]
+        idx = quote_all.replace("：", ":").find(":")
+        if idx < 0:
+            return None, None
+        return quote_all[:idx].strip(), quote_all[idx + 1:].replace("：", ":").strip()
@@ -1,33 +1,111 @@
 import argparse
 import os
+import sys
 
 
 class SimpleConfig:
     def __init__(self):
-        attrs = [_attr_name for _attr_name in dir(self) if not _attr_name.startswith("_") and
-                 (self.__getattribute__(_attr_name) is None or not callable(self.__getattribute__(_attr_name)))]
-        parser = argparse.ArgumentParser()
-        for attr in attrs:
-            parser.add_argument(f"-{attr}", dest=attr, required=False)
-        args = parser.parse_args()
+        attrs = self._attr_names()
+        args = None
+        # argparse is only set up when there is a command line to parse
+        if len(sys.argv) > 1:
+            parser = argparse.ArgumentParser()
+            for attr in attrs:
+                parser.add_argument(f"-{attr}", dest=attr, required=False)
+            args = parser.parse_args()
 
         for attr in attrs:
+            default = getattr(type(self), attr)
             final_value = None
-            if hasattr(args, attr):
+            if args is not None:
                 final_value = getattr(args, attr)
             if final_value is None:
                 final_value = os.environ.get(attr.upper())
             if final_value is None:
-                final_value = self.__getattribute__(attr)
-            self.__setattr__(attr, final_value)
+                final_value = default
+            setattr(self, attr, self._coerce(default, final_value))
+
+    @classmethod
+    def _attr_names(cls):
+        """
+        names of the config keys, collected from the class once instead of through dir() on every instance
+        """
+        names = cls.__dict__.get("_attr_names_cache")
+        if names is None:
+            names = sorted({_name for _klass in cls.__mro__ for _name, _value in vars(_klass).items()
+                            if not _name.startswith("_") and (_value is None or not callable(_value))})
+            cls._attr_names_cache = names
+        return names
+
+    @staticmethod
+    def _coerce(default, value):
+        if not isinstance(value, str) or default is None or isinstance(default, str):
+            return value
+        if isinstance(default, bool):
+            return value.strip().lower() in ("1", "true", "yes", "on")
+        return type(default)(value)
 
 
 class Config(SimpleConfig):
     log_level = "INFO"
+    run_mode = "all"
+    job_queue_path = "jobs.sqlite3"
+    job_lease_seconds = 60
+    job_poll_interval = 0.5
+    job_max_attempts = 3
+    job_registry_path = "results.sqlite3"
+    job_registry_ttl = 30 * 24 * 3600
+    worker_concurrency = 8
+    metrics_host = "127.0.0.1"
+    metrics_port = 0
+    metrics_log_interval = 0
     wechaty_puppet = "wechaty-puppet-service"
     wechaty_puppet_service_token = None
     zhishuyun_chatgpt_35_token = None
     zhishuyun_midjourney_token = None
+    zhishuyun_base_url = "https://api.zhishuyun.com"
+    midjourney_mode = "blocking"
+    midjourney_poll_interval = 5.0
+    midjourney_action_cache_size = 1024
+    midjourney_action_cache_ttl = 12 * 3600
+    midjourney_callback_url = None
+    midjourney_callback_port = 0
+    http_pool_limit = 100
+    http_pool_limit_per_host = 20
+    http_dns_cache_ttl = 300
+    http_keepalive_timeout = 60
+    upstream_limit = 8
+    upstream_limit_max = 64
+    upstream_rate = 0.0
+    upstream_burst = 10
+    upstream_retries = 2
+    upstream_latency_target = 30.0
+    translate_cache_size = 1024
+    translate_cache_ttl = 7 * 24 * 3600
+    translate_cache_path = None
+    translate_batch_window = 0.0
+    translate_batch_size = 8
+    compress_workers = 2
+    compress_max_pending = 32
+    compress_mode = "quality"
+    image_format = "JPEG"
+    image_target_bytes = 0
+    image_quality_min = 40
+    image_quality_max = 90
+    scheduler_max_running = 8
+    scheduler_max_per_room = 3
+    scheduler_max_per_user = 1
+    scheduler_max_queued = 100
+    room_send_rate = 1.0
+    room_send_burst = 3
+    room_send_max_queued = 50
+    room_send_merge = True
+    image_max_bytes = 32 * 1024 * 1024
+    image_cache_bytes = 64 * 1024 * 1024
+    image_cache_ttl = 24 * 3600
+    image_cache_dir = None
+    image_cache_dir_bytes = 512 * 1024 * 1024
+    preview_cache_bytes = 64 * 1024 * 1024
 
     def __repr__(self):
         return "Config(%r)" % self.__dict__
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import aiohttp
+
+log = logging.getLogger(__name__)
+
+
+class HttpPool:
+    def __init__(self, limit=100, limit_per_host=20, dns_cache_ttl=300, keepalive_timeout=60):
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._dns_cache_ttl = dns_cache_ttl
+        self._keepalive_timeout = keepalive_timeout
+        self._session = None
+        self.stats = {
+            "requests": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+            "dns_cache_hits": 0,
+            "dns_cache_misses": 0,
+        }
+
+    @property
+    def session(self) -> "aiohttp.ClientSession":
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+        return self._session
+
+    async def open(self):
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+            log.info(f"HttpPool opened, limit={self._limit}, limit_per_host={self._limit_per_host}")
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            # give ssl transports a moment to shut down, see aiohttp graceful shutdown docs
+            await asyncio.sleep(0.25)
+            log.info(f"HttpPool closed, stats={self.stats}")
+        self._session = None
+
+    def reuse_ratio(self):
+        total = self.stats["connections_created"] + self.stats["connections_reused"]
+        if total == 0:
+            return 0.0
+        return self.stats["connections_reused"] / total
+
+    def _create_session(self):
+        # aiohttp is imported on the first request, not when the bot starts
+        import aiohttp
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(self._on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(self._on_dns_cache_miss)
+        connector = aiohttp.TCPConnector(limit=self._limit, limit_per_host=self._limit_per_host,
+                                         use_dns_cache=True, ttl_dns_cache=self._dns_cache_ttl,
+                                         keepalive_timeout=self._keepalive_timeout)
+        return aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+
+    async def _on_request_start(self, session, ctx, params):
+        self.stats["requests"] += 1
+
+    async def _on_connection_create_end(self, session, ctx, params):
+        self.stats["connections_created"] += 1
+
+    async def _on_connection_reuseconn(self, session, ctx, params):
+        self.stats["connections_reused"] += 1
+
+    async def _on_dns_cache_hit(self, session, ctx, params):
+        self.stats["dns_cache_hits"] += 1
+
+    async def _on_dns_cache_miss(self, session, ctx, params):
+        self.stats["dns_cache_misses"] += 1
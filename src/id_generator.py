@@ -1,22 +1,44 @@
 alphabet = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
 alphabet_idx = {_c: _idx for _idx, _c in enumerate(alphabet)}
+# digits are converted CHUNK at a time, 52 ** 10 still fits a machine word so only one big int operation is
+# done per chunk instead of per digit, and the digits inside a chunk are taken two at a time
+CHUNK = 10
+_powers = [len(alphabet) ** _i for _i in range(CHUNK + 1)]
+_pairs = [_a + _b for _a in alphabet for _b in alphabet]
 
 
 def bytes_to_52(b):
-    base = len(alphabet)
+    pair_base = len(_pairs)
     n = int.from_bytes(b, byteorder='big', signed=False)
-    res = ""
+    digits = []
     while n > 0:
-        n, r = divmod(n, base)
-        res = alphabet[r] + res
-    return res
+        n, chunk = divmod(n, _powers[CHUNK])
+        if n > 0:
+            for _ in range(CHUNK // 2):
+                chunk, r = divmod(chunk, pair_base)
+                digits.append(_pairs[r])
+            continue
+        # the top chunk has no leading zeros
+        while chunk >= pair_base:
+            chunk, r = divmod(chunk, pair_base)
+            digits.append(_pairs[r])
+        if chunk >= len(alphabet):
+            digits.append(_pairs[chunk])
+        elif chunk > 0:
+            digits.append(alphabet[chunk])
+    digits.reverse()
+    return "".join(digits)
 
 
 def s52_to_bytes(s):
     base = len(alphabet)
     n = 0
-    for c in s:
-        n = n * base + alphabet.index(c)
+    for start in range(0, len(s), CHUNK):
+        part = s[start:start + CHUNK]
+        chunk = 0
+        for c in part:
+            chunk = chunk * base + alphabet_idx[c]
+        n = n * _powers[len(part)] + chunk
     b = n.to_bytes((n.bit_length() + 7) // 8, byteorder='big', signed=False)
     return b
 
@@ -1,9 +1,45 @@
+import asyncio
+import functools
 import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-import aiohttp
 import math
-import requests
-from PIL import Image
+
+# PIL and aiohttp are imported by the functions that use them, the bot starts without either
+
+log = logging.getLogger(__name__)
+
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+SNIFF_LIMIT = 1024 * 1024
+
+
+class CompressQueueFull(Exception):
+    pass
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+class MemoryMeter:
+    """
+    bytes held at once by a single send job, download buffer + compressed output + upload payload
+    """
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+
+    def hold(self, size):
+        self.current += size
+        self.peak = max(self.peak, self.current)
+
+    def release(self, size):
+        self.current -= size
 
 
 def _compute_scale(src_width, src_height):
@@ -29,39 +65,272 @@ def _compute_scale(src_width, src_height):
         return math.ceil(long_side / (1280.0 / scale))
 
 
-def _simple_format(img):
-    if img.mode == "RGBA":
-        return img, "PNG"
-    elif img.mode == "RGB":
-        return img, "JPEG"
+ENCODE_FORMATS = ("JPEG", "WEBP")
+_EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp", "PNG": "png", "GIF": "gif"}
+# quality is searched on this step, finer steps cost encodes without a visible difference
+QUALITY_STEP = 5
+# a cached quality is kept while its output lands between this share of the target and the target
+QUALITY_CACHE_SLACK = 0.8
+# chosen quality per (format, target, size class), similar images of a size class usually need a single encode
+_quality_cache = {}
+
+
+def _flatten(img, fmt):
+    from PIL import Image
+
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+    if has_alpha and fmt == "WEBP":
+        return img if img.mode == "RGBA" else img.convert("RGBA")
+    if has_alpha:
+        # jpeg can not show transparency, compose over white like the wechat chat background
+        img = img.convert("RGBA")
+        flat = Image.new("RGB", img.size, (255, 255, 255))
+        flat.paste(img, mask=img.getchannel("A"))
+        return flat
+    if img.mode != "RGB":
+        return img.convert("RGB")
+    return img
+
+
+def _save(img, fmt, quality):
+    bs = io.BytesIO()
+    if fmt == "WEBP":
+        img.save(bs, format="WEBP", quality=quality, method=4)
     else:
-        return img.convert("RGB"), "JPEG"
+        img.save(bs, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return bs.getvalue()
+
+
+def encode(img, fmt="JPEG", target_bytes=0, quality_min=40, quality_max=90):
+    """
+    without target_bytes the image is saved at quality 60, otherwise at the highest quality on the
+    QUALITY_STEP ladder that fits target_bytes, or at quality_min when nothing fits
+    """
+    if target_bytes <= 0:
+        return _save(img, fmt, 60)
+    ladder = list(range(quality_min, quality_max + 1, QUALITY_STEP))
+    key = (fmt, target_bytes, img.size[0] // 256, img.size[1] // 256)
+    encoded = {}
+    lo, hi = 0, len(ladder) - 1
+    cached = _quality_cache.get(key)
+    if cached in ladder:
+        idx = ladder.index(cached)
+        encoded[idx] = _save(img, fmt, cached)
+        size = len(encoded[idx])
+        if target_bytes * QUALITY_CACHE_SLACK <= size <= target_bytes:
+            return encoded[idx]
+        if size <= target_bytes:
+            lo = idx + 1
+        else:
+            hi = idx - 1
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        encoded[mid] = _save(img, fmt, ladder[mid])
+        if len(encoded[mid]) <= target_bytes:
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    # hi is the best index that fits, -1 when even quality_min is too large
+    best = max(hi, 0)
+    _quality_cache[key] = ladder[best]
+    if best not in encoded:
+        encoded[best] = _save(img, fmt, ladder[best])
+    return encoded[best]
+
+
+def image_extension(bs):
+    """
+    file extension of encoded image bytes, the upload name has to match what the bytes are
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(io.BytesIO(bs)) as img:
+            return _EXTENSIONS.get(img.format, "jpg")
+    except (UnidentifiedImageError, OSError):
+        return "jpg"
+
 
+# quality: full decode + LANCZOS, balanced: cheap integer reduce down to 2x the target then BICUBIC (at a scale
+# of 2, which midjourney grids of 2048 to 4096px get, that is only BICUBIC instead of LANCZOS),
+# fast: cheap integer reduce all the way down to the target
+COMPRESS_MODES = ("quality", "balanced", "fast")
 
-def compress(img):
-    _img, _format = _simple_format(img)
-    src_width, src_height = _img.size
+
+def _draft(img, size, mode):
+    if mode == "quality" or img.format != "JPEG":
+        return
+    if mode == "balanced":
+        size = (size[0] * 2, size[1] * 2)
+    # jpeg draft decodes at 1/2, 1/4 or 1/8 scale while keeping the result at least `size`
+    img.draft(img.mode, size)
+
+
+def _resize(img, size, mode):
+    from PIL import Image
+
+    if img.size == size:
+        return img
+    if mode != "quality":
+        factor = min(img.size[0] // size[0], img.size[1] // size[1])
+        if mode == "balanced":
+            factor //= 2
+        if factor > 1:
+            img = img.reduce(factor)
+            if img.size == size:
+                return img
+        if mode == "balanced":
+            return img.resize(size, Image.BICUBIC)
+    return img.resize(size, Image.LANCZOS)
+
+
+def compress(img, mode="quality", fmt="JPEG", target_bytes=0, quality_min=40, quality_max=90):
+    src_width, src_height = img.size
     scale = _compute_scale(src_width, src_height)
-    new_img = _img.resize((src_width // scale, src_height // scale), Image.LANCZOS)
-    new_bs = io.BytesIO()
-    new_img.save(new_bs, format=_format, quality=60)
-    return new_bs.getvalue()
+    size = (src_width // scale, src_height // scale)
+    if scale > 1:
+        _draft(img, size, mode)
+    new_img = _resize(_flatten(img, fmt), size, mode)
+    return encode(new_img, fmt, target_bytes, quality_min, quality_max)
 
 
-def compress_from_url(url):
-    resp = requests.get(url, timeout=60)
-    if resp.status_code == 200:
-        return compress(Image.open(io.BytesIO(resp.content)))
-    else:
-        raise ValueError(f"[{resp.status_code}] {resp.text}")
+def compress_bytes(bs, mode="quality", fmt="JPEG", target_bytes=0, quality_min=40, quality_max=90):
+    from PIL import Image
+
+    return compress(Image.open(io.BytesIO(bs)), mode, fmt, target_bytes, quality_min, quality_max)
+
+
+def split_grid(img, mode="quality", fmt="JPEG", target_bytes=0, quality_min=40, quality_max=90):
+    """
+    the four encoded tiles of a 2x2 midjourney grid, numbered like /u1 to /u4: left to right, top to bottom.
+    The grid is decoded and flattened once, every tile is cut from the same pixels
+    """
+    flat = _flatten(img, fmt)
+    half_width, half_height = flat.size[0] // 2, flat.size[1] // 2
+    tiles = []
+    for top in (0, half_height):
+        for left in (0, half_width):
+            tile = flat.crop((left, top, left + half_width, top + half_height))
+            scale = _compute_scale(half_width, half_height)
+            tile = _resize(tile, (half_width // scale, half_height // scale), mode)
+            tiles.append(encode(tile, fmt, target_bytes, quality_min, quality_max))
+    return tiles
+
+
+def split_grid_bytes(bs, mode="quality", fmt="JPEG", target_bytes=0, quality_min=40, quality_max=90):
+    from PIL import Image
+
+    return split_grid(Image.open(io.BytesIO(bs)), mode, fmt, target_bytes, quality_min, quality_max)
 
 
-async def compress_from_url1(url):
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300)) as session:
-        async with session.get(url=url) as resp:
-            if resp.status == 200:
-                resp_bs = await resp.read()
-                return compress(Image.open(io.BytesIO(resp_bs)))
+class CompressPool:
+    def __init__(self, workers=2, max_pending=32, mode="quality", fmt="JPEG", target_bytes=0, quality_min=40,
+                 quality_max=90):
+        self._workers = workers
+        self._max_pending = max_pending
+        self._compress = functools.partial(compress_bytes, mode=mode, fmt=fmt, target_bytes=target_bytes,
+                                           quality_min=quality_min, quality_max=quality_max)
+        self._split_grid = functools.partial(split_grid_bytes, mode=mode, fmt=fmt, target_bytes=target_bytes,
+                                             quality_min=quality_min, quality_max=quality_max)
+        self._executor = None
+        self._pending = 0
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "pending": 0, "max_pending": 0}
+
+    async def compress(self, bs):
+        return await self._run(self._compress, bs)
+
+    async def split_grid(self, bs):
+        return await self._run(self._split_grid, bs)
+
+    async def _run(self, func, bs):
+        if self._pending >= self._max_pending:
+            self.stats["rejected"] += 1
+            raise CompressQueueFull(f"compress queue is full with {self._pending} pending jobs")
+        self._pending += 1
+        self.stats["submitted"] += 1
+        self.stats["pending"] = self._pending
+        self.stats["max_pending"] = max(self.stats["max_pending"], self._pending)
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, bs)
+            self.stats["completed"] += 1
+            return result
+        except BrokenProcessPool:
+            log.error("CompressPool worker died, the pool will be recreated")
+            self._executor = None
+            self.stats["failed"] += 1
+            raise
+        except:
+            self.stats["failed"] += 1
+            raise
+        finally:
+            self._pending -= 1
+            self.stats["pending"] = self._pending
+
+    def _get_executor(self):
+        if self._workers <= 0:
+            # default thread pool, still keeps PIL work off the event loop
+            return None
+        if self._executor is None:
+            # spawn instead of fork, forking a process with live grpc/event loop threads is unsafe
+            self._executor = ProcessPoolExecutor(max_workers=self._workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+def _sniff_size(head):
+    from PIL import Image, UnidentifiedImageError
+
+    # Image.open only parses the header, pixel data is not decoded or allocated here
+    try:
+        with Image.open(io.BytesIO(head)) as img:
+            return img.size
+    except (UnidentifiedImageError, SyntaxError, OSError, EOFError):
+        return None
+
+
+async def download1(session, url, max_bytes=32 * 1024 * 1024, max_pixels=64 * 1024 * 1024):
+    """
+    stream the body into one buffer sized from content-length, the image header is sniffed as soon as it
+    arrives so oversized or non-image bodies are rejected before they are fully downloaded
+    """
+    import aiohttp
+
+    async with session.get(url=url, timeout=aiohttp.ClientTimeout(total=300)) as resp:
+        if resp.status != 200:
+            resp_text = await resp.text()
+            raise ValueError(f"[{resp.status}] {resp_text}")
+        if resp.content_length is not None and resp.content_length > max_bytes:
+            raise ImageTooLarge(f"image is {resp.content_length} bytes, limit {max_bytes}")
+        buf = bytearray(resp.content_length or 0)
+        view = memoryview(buf)
+        size = 0
+        sniffed = False
+        async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            end = size + len(chunk)
+            if end > max_bytes:
+                raise ImageTooLarge(f"image exceeds {max_bytes} bytes")
+            if end <= len(buf):
+                view[size:end] = chunk
             else:
-                resp_text = await resp.text()
-                raise ValueError(f"[{resp.status}] {resp_text}")
+                view.release()
+                buf[size:] = chunk
+                view = memoryview(buf)
+            size = end
+            if not sniffed:
+                image_size = _sniff_size(view[:size])
+                if image_size is not None:
+                    sniffed = True
+                    if image_size[0] * image_size[1] > max_pixels:
+                        raise ImageTooLarge(f"image is {image_size[0]}x{image_size[1]}, limit {max_pixels} pixels")
+                elif size > SNIFF_LIMIT:
+                    raise ValueError(f"response of {url} is not a recognizable image")
+        view.release()
+        if size < len(buf):
+            del buf[size:]
+        return buf
+
@@ -0,0 +1,197 @@
+import json
+import logging
+import sqlite3
+import time
+
+from src.command_parser import Command
+from src.job_runner import Job
+from src.scheduler import SchedulerFull
+
+log = logging.getLogger(__name__)
+
+# a room message that failed this many sends is given up
+OUTBOX_MAX_ATTEMPTS = 5
+
+
+class JobQueue:
+    """
+    durable queue shared by the ingestion process and the job workers through one SQLite file. Jobs are leased
+    to a worker and go back to the queue when the lease runs out, the checkpoints saved with a job (translation,
+    upstream task id, midjourney response) let the next worker continue instead of submitting again. Messages
+    for the rooms travel back the same way through the outbox table
+    """
+
+    def __init__(self, path, lease=60):
+        self._lease = lease
+        # autocommit, claims open their own IMMEDIATE transaction so two workers never take the same job
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS jobs "
+                           "(id INTEGER PRIMARY KEY AUTOINCREMENT, room_id TEXT NOT NULL, user_id TEXT NOT NULL, "
+                           "command TEXT NOT NULL, command_idx INTEGER, args_text TEXT NOT NULL, image_id TEXT, "
+                           "action_str TEXT NOT NULL, priority INTEGER NOT NULL, state TEXT NOT NULL, worker TEXT, "
+                           "lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, translated TEXT, task_id TEXT, "
+                           "response TEXT, created REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority, id)")
+        columns = {_row[1] for _row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "image_url" not in columns:
+            # queues created before previews existed
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN image_url TEXT")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS outbox "
+                           "(id INTEGER PRIMARY KEY AUTOINCREMENT, job_id INTEGER, room_id TEXT NOT NULL, "
+                           "content TEXT, data BLOB, name TEXT, mention_ids TEXT, merge INTEGER NOT NULL, "
+                           "state TEXT NOT NULL, created REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, id)")
+        columns = {_row[1] for _row in self._conn.execute("PRAGMA table_info(outbox)")}
+        if "attempts" not in columns:
+            # outboxes created before failed sends were retried
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+    def put(self, job: Job, max_queued=None):
+        if max_queued is not None:
+            queued, = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()
+            if queued >= max_queued:
+                raise SchedulerFull(f"{queued} jobs queued, limit {max_queued}")
+        cursor = self._conn.execute(
+            "INSERT INTO jobs (room_id, user_id, command, command_idx, args_text, image_id, image_url, action_str, "
+            "priority, state, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?)",
+            (job.room_id, job.user_id, job.command.value, job.command_idx, job.args_text, job.image_id,
+             job.image_url, job.action_str, job.priority, job.created_at))
+        job.job_id = cursor.lastrowid
+        return job.job_id
+
+    def position(self, job_id):
+        """
+        jobs ahead of job_id that no worker has taken yet
+        """
+        row = self._conn.execute("SELECT priority FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return 0
+        ahead, = self._conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND (priority < ? OR (priority = ? AND id < ?))",
+            (row[0], row[0], job_id)).fetchone()
+        return ahead
+
+    def claim(self, worker, max_per_room=3, max_per_user=1):
+        """
+        the next queued job, or one whose worker stopped renewing its lease, that does not exceed the per room
+        and per user limits counted over every worker
+        """
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute(
+                "SELECT id FROM jobs WHERE (state = 'queued' OR (state = 'running' AND lease_until < :now)) "
+                "AND room_id NOT IN (SELECT room_id FROM jobs WHERE state = 'running' AND lease_until >= :now "
+                "GROUP BY room_id HAVING COUNT(*) >= :max_per_room) "
+                "AND user_id NOT IN (SELECT user_id FROM jobs WHERE state = 'running' AND lease_until >= :now "
+                "GROUP BY user_id HAVING COUNT(*) >= :max_per_user) "
+                "ORDER BY priority, id LIMIT 1",
+                {"now": now, "max_per_room": max_per_room, "max_per_user": max_per_user}).fetchone()
+            if row is None:
+                self._conn.execute("COMMIT")
+                return None
+            self._conn.execute("UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, "
+                               "attempts = attempts + 1 WHERE id = ?", (worker, now + self._lease, row[0]))
+            job_row = self._conn.execute(
+                "SELECT id, room_id, user_id, command, command_idx, args_text, image_id, image_url, action_str, "
+                "priority, translated, task_id, response, created, attempts FROM jobs WHERE id = ?",
+                (row[0],)).fetchone()
+            self._conn.execute("COMMIT")
+        except:
+            self._conn.execute("ROLLBACK")
+            raise
+        (job_id, room_id, user_id, command, command_idx, args_text, image_id, image_url, action_str, priority,
+         translated, task_id, response, created, attempts) = job_row
+        job = Job(room_id, user_id, Command(command), command_idx, args_text, image_id, action_str, priority,
+                  job_id=job_id, translated=translated, task_id=task_id,
+                  response=json.loads(response) if response is not None else None, created_at=created,
+                  image_url=image_url)
+        job.attempts = attempts
+        return job
+
+    def checkpoint(self, job: Job):
+        self._conn.execute("UPDATE jobs SET translated = ?, task_id = ?, response = ?, lease_until = ? WHERE id = ?",
+                           (job.translated, job.task_id,
+                            json.dumps(job.response, ensure_ascii=False) if job.response is not None else None,
+                            time.time() + self._lease, job.job_id))
+
+    def renew(self, job_ids, worker):
+        lease_until = time.time() + self._lease
+        self._conn.executemany("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ?",
+                               [(lease_until, _id, worker) for _id in job_ids])
+
+    def finish(self, job: Job):
+        self._conn.execute("DELETE FROM jobs WHERE id = ?", (job.job_id,))
+
+    def say(self, job_id, room_id, content, mention_ids=None, merge=True):
+        # a worker only loads the puppet package when it sends its first image
+        from wechaty_puppet import FileBox
+
+        if isinstance(content, FileBox):
+            self._conn.execute("INSERT INTO outbox (job_id, room_id, data, name, merge, state, created) "
+                               "VALUES (?, ?, ?, ?, ?, 'pending', ?)",
+                               (job_id, room_id, content.base64, content.name, int(merge), time.time()))
+        else:
+            self._conn.execute("INSERT INTO outbox (job_id, room_id, content, mention_ids, merge, state, created) "
+                               "VALUES (?, ?, ?, ?, ?, 'pending', ?)",
+                               (job_id, room_id, content, json.dumps(mention_ids) if mention_ids else None,
+                                int(merge), time.time()))
+
+    def take_outbox(self, limit=100):
+        """
+        [(row_id, job_id, room_id, content, mention_ids, merge)] in the order the workers wrote them,
+        content is a str or a FileBox, the rows stay marked as sending until outbox_done or outbox_failed
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self._conn.execute("SELECT id, job_id, room_id, content, data, name, mention_ids, merge "
+                                      "FROM outbox WHERE state = 'pending' ORDER BY id LIMIT ?", (limit,)).fetchall()
+            if rows:
+                self._conn.executemany("UPDATE outbox SET state = 'sending' WHERE id = ?", [(_r[0],) for _r in rows])
+            self._conn.execute("COMMIT")
+        except:
+            self._conn.execute("ROLLBACK")
+            raise
+        from wechaty_puppet import FileBox
+
+        messages = []
+        for row_id, job_id, room_id, content, data, name, mention_ids, merge in rows:
+            if data is not None:
+                content = FileBox.from_base64(base64=data, name=name)
+            messages.append((row_id, job_id, room_id, content, json.loads(mention_ids) if mention_ids else None,
+                             bool(merge)))
+        return messages
+
+    def outbox_done(self, row_id):
+        self._conn.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+
+    def outbox_failed(self, row_id, max_attempts=OUTBOX_MAX_ATTEMPTS):
+        """
+        a message that could not be sent goes back to pending until it failed max_attempts times
+        """
+        self._conn.execute("UPDATE outbox SET state = 'pending', attempts = attempts + 1 WHERE id = ?", (row_id,))
+        cursor = self._conn.execute("DELETE FROM outbox WHERE id = ? AND attempts >= ?", (row_id, max_attempts))
+        if cursor.rowcount:
+            log.error(f"JobQueue gives up outbox message {row_id} after {max_attempts} failed sends")
+
+    def reset_outbox(self, sending=()):
+        """
+        messages an earlier ingestion process took but did not finish are sent again, except the row ids in
+        sending that this process still has on their way
+        """
+        self._conn.execute("UPDATE outbox SET state = 'pending' WHERE state = 'sending'")
+        if sending:
+            self._conn.executemany("UPDATE outbox SET state = 'sending' WHERE id = ?", [(_id,) for _id in sending])
+
+    @property
+    def stats(self):
+        stats = {"queued": 0, "running": 0, "outbox_pending": 0, "outbox_sending": 0}
+        for state, count in self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"):
+            stats[state] = count
+        for state, count in self._conn.execute("SELECT state, COUNT(*) FROM outbox GROUP BY state"):
+            stats[f"outbox_{state}"] = count
+        return stats
+
+    def close(self):
+        self._conn.close()
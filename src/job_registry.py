@@ -0,0 +1,71 @@
+import json
+import logging
+import sqlite3
+import time
+from typing import List, NamedTuple, Optional
+
+log = logging.getLogger(__name__)
+
+# expired results are deleted every this many puts
+PURGE_EVERY = 1000
+
+
+class JobRecord(NamedTuple):
+    job_id: str
+    image_id: str
+    room_id: str
+    user_id: str
+    command: str
+    prompt: str
+    translated: Optional[str]
+    image_url: str
+    actions: List[str]
+    created: float
+    finished: float
+
+
+class JobRegistry:
+    """
+    results the bot sent, keyed by the short job id printed in the result message. A quoted command looks its
+    image up here instead of trusting the quoted text, which wechat may have cut short. path ":memory:" keeps
+    the registry in this process, a file is shared by the ingestion process and the job workers
+    """
+
+    def __init__(self, path=":memory:", ttl=None):
+        self._ttl = ttl
+        self._puts = 0
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS results "
+                           "(job_id TEXT PRIMARY KEY, image_id TEXT NOT NULL, room_id TEXT NOT NULL, "
+                           "user_id TEXT NOT NULL, command TEXT NOT NULL, prompt TEXT NOT NULL, translated TEXT, "
+                           "image_url TEXT NOT NULL, actions TEXT NOT NULL, created REAL NOT NULL, "
+                           "finished REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_finished ON results (finished)")
+        self.stats = {"puts": 0, "hits": 0, "misses": 0, "purged": 0}
+
+    def put(self, record: JobRecord):
+        self._conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           record[:8] + (json.dumps(record.actions), record.created, record.finished))
+        self.stats["puts"] += 1
+        self._puts += 1
+        if self._ttl is not None and self._puts % PURGE_EVERY == 0:
+            self.purge()
+
+    def get(self, job_id) -> Optional[JobRecord]:
+        row = self._conn.execute("SELECT * FROM results WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None or (self._ttl is not None and time.time() - row[10] > self._ttl):
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return JobRecord(*row[:8], json.loads(row[8]), row[9], row[10])
+
+    def purge(self):
+        cursor = self._conn.execute("DELETE FROM results WHERE finished < ?", (time.time() - self._ttl,))
+        self.stats["purged"] += cursor.rowcount
+        if cursor.rowcount:
+            log.info(f"JobRegistry purged {cursor.rowcount} expired results")
+
+    def close(self):
+        self._conn.close()
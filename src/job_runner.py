@@ -0,0 +1,389 @@
+import asyncio
+import base64
+import logging
+import random
+import resource
+import time
+import traceback
+
+from src import Config, id_generator, img_compress
+from src.cache import AsyncLRUCache, DirStore, SqliteStore
+from src.command_parser import Command, tip1, tip2, tip3
+from src.http_pool import HttpPool
+from src.job_registry import JobRecord, JobRegistry
+from src.limiter import AdaptiveLimiter, TokenBucket
+from src.metrics import JobTrace, registry
+from src.translate import BatchingTranslator, CachedTranslator, LocalFirstTranslator, ZhiShuYunGPTTranslator
+from src.zsy_midjourney import CachedMidjourney, MidjourneyCallbackServer, ZhiShuYunMidjourney
+
+log = logging.getLogger(__name__)
+
+
+command2short = {
+    Command.upsample: "u",
+    Command.variation: "v",
+}
+
+short2comment = {
+    "u": "进行放大",
+    "v": "进行变换",
+    "p": "预览大图（本地裁剪，不消耗额度）",
+}
+
+
+class Job:
+    """
+    one accepted drawing command, translated/task_id/response are checkpoints a resumed job does not redo
+    """
+
+    def __init__(self, room_id, user_id, command: Command, command_idx, args_text, image_id, action_str, priority,
+                 job_id=None, translated=None, task_id=None, response=None, created_at=None, image_url=None):
+        self.job_id = job_id
+        self.room_id = room_id
+        self.user_id = user_id
+        self.command = command
+        self.command_idx = command_idx
+        self.args_text = args_text
+        self.image_id = image_id
+        # grid a preview is cut from, only set for Command.preview
+        self.image_url = image_url
+        self.action_str = action_str
+        self.priority = priority
+        self.translated = translated
+        self.task_id = task_id
+        self.response = response
+        self.created_at = created_at if created_at is not None else time.time()
+        self.attempts = 0
+
+
+class JobRunner:
+    """
+    everything a job does after it was accepted: translation, midjourney, download, compress and the messages
+    back to the room, which are handed to send(room_id, content, mention_ids=None, job=None, merge=True) and
+    so can go straight to a RoomSender or through the job queue to the ingestion process
+    """
+
+    def __init__(self, config: Config, send, midjourney_mode=None, job_registry: JobRegistry = None):
+        self._send = send
+        self._job_registry = job_registry
+        self._http = HttpPool(limit=config.http_pool_limit, limit_per_host=config.http_pool_limit_per_host,
+                              dns_cache_ttl=config.http_dns_cache_ttl,
+                              keepalive_timeout=config.http_keepalive_timeout)
+        # one bucket for the account quota, one AIMD limiter per endpoint
+        bucket = TokenBucket(config.upstream_rate, config.upstream_burst) if config.upstream_rate > 0 else None
+        chatgpt_limiter = AdaptiveLimiter("chatgpt", limit=config.upstream_limit, max_limit=config.upstream_limit_max,
+                                          bucket=bucket, latency_target=config.upstream_latency_target,
+                                          retries=config.upstream_retries)
+        # a lost answer may still have started a drawing, a gateway 502/503 in front of a blocking imagine does
+        # not prove the upstream rejected it, only a throttled submit (429) is surely not accepted and retried
+        imagine_limiter = AdaptiveLimiter("midjourney_imagine", limit=config.upstream_limit,
+                                          max_limit=config.upstream_limit_max, bucket=bucket,
+                                          retries=config.upstream_retries, retry_statuses=(429,))
+        tasks_limiter = AdaptiveLimiter("midjourney_tasks", limit=config.upstream_limit,
+                                        max_limit=config.upstream_limit_max, bucket=bucket,
+                                        latency_target=config.upstream_latency_target, retries=config.upstream_retries)
+        translate_store = None
+        if config.translate_cache_path:
+            translate_store = SqliteStore(config.translate_cache_path, table="translate",
+                                          ttl=config.translate_cache_ttl)
+        translator = ZhiShuYunGPTTranslator(config.zhishuyun_chatgpt_35_token, self._http, config.zhishuyun_base_url,
+                                            chatgpt_limiter)
+        self._batching_translator = None
+        if config.translate_batch_window > 0:
+            translator = self._batching_translator = BatchingTranslator(
+                translator, window=config.translate_batch_window, max_batch=config.translate_batch_size)
+        self._translate_cache = CachedTranslator(
+            translator,
+            AsyncLRUCache(max_entries=config.translate_cache_size, ttl=config.translate_cache_ttl,
+                          store=translate_store))
+        self._translator = LocalFirstTranslator(self._translate_cache)
+        self._midjourney = CachedMidjourney(
+            ZhiShuYunMidjourney(config.zhishuyun_midjourney_token, self._http, config.zhishuyun_base_url,
+                                midjourney_mode or config.midjourney_mode, config.midjourney_callback_url,
+                                config.midjourney_poll_interval, imagine_limiter, tasks_limiter),
+            AsyncLRUCache(max_entries=config.midjourney_action_cache_size, ttl=config.midjourney_action_cache_ttl))
+        self._callback_server = None
+        self._opened = False
+        if self._midjourney.poller is not None and config.midjourney_callback_port:
+            self._callback_server = MidjourneyCallbackServer(self._midjourney.poller,
+                                                             port=config.midjourney_callback_port)
+        self._compress_pool = img_compress.CompressPool(workers=config.compress_workers,
+                                                        max_pending=config.compress_max_pending,
+                                                        mode=config.compress_mode,
+                                                        fmt=config.image_format.upper(),
+                                                        target_bytes=config.image_target_bytes,
+                                                        quality_min=config.image_quality_min,
+                                                        quality_max=config.image_quality_max)
+        self._image_max_bytes = config.image_max_bytes
+        image_store = None
+        if config.image_cache_dir:
+            image_store = DirStore(config.image_cache_dir, max_bytes=config.image_cache_dir_bytes,
+                                   ttl=config.image_cache_ttl)
+        self._image_cache = AsyncLRUCache(max_entries=4096, ttl=config.image_cache_ttl, store=image_store,
+                                          max_bytes=config.image_cache_bytes, sizeof=len)
+        # the four tiles of a grid are cut together, a preview of any tile serves the other three
+        self._preview_cache = AsyncLRUCache(max_entries=1024, ttl=config.image_cache_ttl,
+                                            max_bytes=config.preview_cache_bytes,
+                                            sizeof=lambda _tiles: sum(len(_t) for _t in _tiles))
+        self.image_stats = {"jobs": 0, "job_peak_bytes_last": 0, "job_peak_bytes_max": 0, "peak_rss_kb": 0}
+        registry.register_stats("http_pool", lambda: self._http.stats)
+        for limiter in (chatgpt_limiter, imagine_limiter, tasks_limiter):
+            registry.register_stats(f"upstream_{limiter.name}", lambda _limiter=limiter: _limiter.stats)
+        self._limiters = (chatgpt_limiter, imagine_limiter, tasks_limiter)
+        registry.register_stats("translate_local", lambda: self._translator.stats)
+        registry.register_stats("translate_cache", lambda: self._translate_cache.stats)
+        if self._batching_translator is not None:
+            registry.register_stats("translate_batch", lambda: self._batching_translator.stats)
+        registry.register_stats("midjourney_action_cache", lambda: self._midjourney.stats)
+        if self._midjourney.poller is not None:
+            registry.register_stats("midjourney_poller", lambda: self._midjourney.poller.stats)
+        registry.register_stats("image_cache", lambda: self._image_cache.stats)
+        registry.register_stats("image", lambda: self.image_stats)
+        registry.register_stats("preview_cache", lambda: self._preview_cache.stats)
+        registry.register_stats("compress_pool", lambda: self._compress_pool.stats)
+
+    async def open(self):
+        # every login opens the runner, only the first one after a shutdown does anything
+        if self._opened:
+            return
+        self._opened = True
+        await self._http.open()
+        if self._callback_server is not None:
+            await self._callback_server.start()
+
+    async def shutdown(self):
+        self._opened = False
+        if self._callback_server is not None:
+            await self._callback_server.stop()
+        if self._midjourney.poller is not None:
+            # a poll after this would open a new session on the closed pool
+            self._midjourney.poller.close()
+        await self._http.close()
+        self._compress_pool.shutdown()
+
+    def close(self):
+        # stores outlive stop/start cycles of Wechaty.restart, they are only closed on process exit
+        self._translator.close()
+        self._midjourney.close()
+        self._image_cache.close()
+
+    def log_stats(self):
+        log.info(f"http pool reuse ratio {self._http.reuse_ratio():.2f}, stats={self._http.stats}")
+        for limiter in self._limiters:
+            log.info(f"upstream {limiter.name} stats={limiter.stats}")
+        log.info(f"translate local stats={self._translator.stats}")
+        log.info(f"translate cache stats={self._translate_cache.stats}")
+        log.info(f"midjourney action cache stats={self._midjourney.stats}")
+        log.info(f"image cache hit ratio {self._image_cache.hit_ratio():.2f}, stats={self._image_cache.stats}")
+        log.info(f"image stats={self.image_stats}")
+        log.info(f"preview cache hit ratio {self._preview_cache.hit_ratio():.2f}, stats={self._preview_cache.stats}")
+
+    async def translate1(self, args_text, trace: JobTrace):
+        with trace.stage("translate"):
+            return await self._translator.run1(args_text)
+
+    async def run(self, job: Job, trace: JobTrace, translating=None, checkpoint=None):
+        """
+        translating is an already started translate1 of job.args_text, checkpoint(job) is called whenever the
+        job made progress that must not be repeated after a restart
+        """
+        # a job taken over from another worker reports the time since it was accepted
+        _start = time.time() if job.attempts <= 1 else job.created_at
+        if job.command == Command.preview:
+            await self.send_preview(job, trace)
+            return
+        mention_ids = [job.user_id]
+        translated = job.translated
+        if job.command == Command.generate and translated is None:
+            if translating is None:
+                translating = self.translate1(job.args_text, trace)
+            status, translated = await translating
+            if not status:
+                trace.error("translate", translated)
+                if 400 <= translated < 500:
+                    self.error_4xx(job)
+                    return
+                if 500 <= translated:
+                    self.error_5xx(job)
+                    return
+                return
+            log.info(f"Translated from [{job.args_text}] 2 [{translated}]")
+            job.translated = translated
+            if checkpoint is not None:
+                checkpoint(job)
+            if time.time() - _start > 8:
+                self._send(job.room_id, "⏳仍在继续生成中...", mention_ids=mention_ids, job=job)
+        response = job.response
+        if response is None:
+            async def on_submitted(task_id):
+                job.task_id = task_id
+                if checkpoint is not None:
+                    checkpoint(job)
+
+            with trace.stage("midjourney"):
+                status, response = await self._midjourney.run1(job.action_str, translated, job.image_id,
+                                                               job.task_id, on_submitted)
+            if not status:
+                trace.error("midjourney", response)
+                if 400 <= response < 500:
+                    self.error_4xx(job)
+                    return
+                if 500 <= response:
+                    self.error_5xx(job)
+                    return
+                return
+            job.response = response
+            if checkpoint is not None:
+                checkpoint(job)
+        _end = time.time()
+        self._send(job.room_id, "⏳生成结束，正在下载、压缩、上传图片...", mention_ids=mention_ids, job=job)
+        await self.send_image(job, response, trace)
+        job_id = id_generator.encode(str(response['image_id']))
+        self._register(job, job_id, translated, response)
+        if job.command == Command.generate:
+            self._send(
+                job.room_id, f"{tip1}（{int(_end - _start)}秒）\n{tip2} {job_id}\n{tip3} {response['image_url']}\nPrompt: {job.args_text}\nReal Prompt: {translated}\n\n{self.parse_commands(response['actions'], job_id)}",
+                mention_ids=mention_ids, job=job, merge=False)
+        else:
+            self._send(
+                job.room_id, f"{tip1}（{int(_end - _start)}秒）\n{tip2} {job_id}\n{tip3} {response['image_url']}\nReal Command: /{job.command.value}{job.command_idx}\n\n{self.parse_commands(response['actions'], job_id)}",
+                mention_ids=mention_ids, job=job, merge=False)
+
+    def _register(self, job: Job, job_id, translated, response):
+        # recorded before the result goes out, a quote of it can arrive right after
+        if self._job_registry is None:
+            return
+        try:
+            self._job_registry.put(JobRecord(job_id, str(response["image_id"]), job.room_id, job.user_id,
+                                             job.command.value, job.args_text, translated, response["image_url"],
+                                             response.get("actions") or [], job.created_at, time.time()))
+        except:
+            log.error(f"register job {job_id} fail\n{traceback.format_exc()}")
+
+    async def send_image(self, job: Job, response, trace: JobTrace):
+        """
+        the download starts right away, the status message queued before it goes out in parallel
+        """
+        from wechaty_puppet import FileBox
+
+        meter = img_compress.MemoryMeter()
+        try:
+            _, pic_bytes = await self._image_cache.get_or_load(
+                response["image_url"], lambda: self._load_image(response["image_url"], meter, trace))
+            meter.hold(len(pic_bytes))
+            name = f"IMAGE.{img_compress.image_extension(pic_bytes)}"
+            # the puppet service protocol only carries base64 file boxes, encode straight from the buffer and
+            # drop the raw bytes before the upload so only one copy stays alive while room.say is pending
+            b64 = base64.b64encode(memoryview(pic_bytes))
+            meter.hold(len(b64))
+            meter.release(len(pic_bytes))
+            del pic_bytes
+            fb = FileBox.from_base64(base64=b64, name=name)
+            del b64
+            # handing the image over, room queue and pacing included, the room.say itself is the upload stage
+            with trace.stage("deliver"):
+                sent = await self._send(job.room_id, fb, job=job)
+            if not sent:
+                raise RuntimeError("upload image fail")
+            self._record_image_memory(response["image_url"], meter)
+        except asyncio.CancelledError:
+            raise
+        except:
+            trace.error("send_image", 600)
+            log.error(f"send image fail\n{traceback.format_exc()}")
+            self._send(job.room_id, f"⭕图片下载失败，请直接访问原链接: {response['image_url']}", job=job, merge=False)
+
+    async def send_preview(self, job: Job, trace: JobTrace):
+        """
+        tile job.command_idx of the grid at job.image_url, cut locally instead of a paid upsample
+        """
+        from wechaty_puppet import FileBox
+
+        try:
+            _, tiles = await self._preview_cache.get_or_load(job.image_url,
+                                                             lambda: self._load_tiles(job.image_url, trace))
+            tile = tiles[job.command_idx - 1]
+            fb = FileBox.from_base64(base64=base64.b64encode(tile),
+                                     name=f"IMAGE{job.command_idx}.{img_compress.image_extension(tile)}")
+            with trace.stage("deliver"):
+                sent = await self._send(job.room_id, fb, job=job)
+            if not sent:
+                raise RuntimeError("upload preview fail")
+        except asyncio.CancelledError:
+            raise
+        except:
+            trace.error("send_preview", 600)
+            log.error(f"send preview fail\n{traceback.format_exc()}")
+            self._send(job.room_id, f"⭕预览图片生成失败，请直接访问原链接: {job.image_url}",
+                       mention_ids=[job.user_id], job=job, merge=False)
+            return
+        self._send(job.room_id, f"🔍图片{job.command_idx}预览，引用原消息发送 /u{job.command_idx} 可获取高清大图",
+                   mention_ids=[job.user_id], job=job)
+
+    async def _load_tiles(self, image_url, trace: JobTrace):
+        with trace.stage("download"):
+            buf = await img_compress.download1(self._http.session, image_url, max_bytes=self._image_max_bytes)
+        with trace.stage("crop"):
+            return True, await self._compress_pool.split_grid(buf)
+
+    async def _load_image(self, image_url, meter: img_compress.MemoryMeter, trace: JobTrace):
+        with trace.stage("download"):
+            buf = await img_compress.download1(self._http.session, image_url, max_bytes=self._image_max_bytes)
+        download_size = len(buf)
+        meter.hold(download_size)
+        try:
+            with trace.stage("compress"):
+                result = await self._compress_pool.compress(buf)
+            meter.hold(len(result))
+            meter.release(len(result))
+            return True, result
+        finally:
+            del buf
+            meter.release(download_size)
+
+    def _record_image_memory(self, image_url, meter: img_compress.MemoryMeter):
+        self.image_stats["jobs"] += 1
+        self.image_stats["job_peak_bytes_last"] = meter.peak
+        self.image_stats["job_peak_bytes_max"] = max(self.image_stats["job_peak_bytes_max"], meter.peak)
+        self.image_stats["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        log.info(f"send image {image_url} peak job memory {meter.peak / 1024:.0f}KB, "
+                 f"process peak rss {self.image_stats['peak_rss_kb']}KB")
+
+    def error_4xx(self, job: Job):
+        self._send(job.room_id, f"⭕当前服务配置不正确，请联系管理员处理", mention_ids=[job.user_id], job=job,
+                   merge=False)
+
+    def error_5xx(self, job: Job):
+        self._send(job.room_id, f"⭕Midjourney未正确返回结果或超时，请重试或联系管理员处理", mention_ids=[job.user_id], job=job,
+                   merge=False)
+
+    @staticmethod
+    def parse_commands(actions, job_id):
+        all_shorts = set()
+        command_count = dict()
+        for action in actions:
+            if len(action) < 2:
+                continue
+            try:
+                command, idx = Command(action[:-1]), int(action[-1])
+            except ValueError:
+                continue
+            if command not in command2short:
+                continue
+            all_shorts.add(command2short[command])
+            if command not in command_count:
+                command_count[command2short[command]] = set()
+            command_count[command2short[command]].add(idx)
+        if len(all_shorts) == 0:
+            return ""
+        if "u" in command_count:
+            # a result that can be upsampled is a grid, its tiles can be previewed locally
+            all_shorts.add("p")
+            command_count["p"] = command_count["u"]
+        tips = "💡继续生成图片, @ 我并**引用**此消息，支持以下命令:\n"
+        for sc in all_shorts:
+            tips += "- /%s{图片编号} %s\n" % (sc, short2comment[sc])
+        tips += "例如:\n"
+        for cmd, idxs in command_count.items():
+            tips += f"/{cmd}{random.choice(list(idxs))}\n"
+        return tips.strip()
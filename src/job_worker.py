@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import os
+import socket
+import traceback
+
+from src import Config
+from src.job_queue import JobQueue
+from src.job_registry import JobRegistry
+from src.job_runner import Job, JobRunner
+from src.metrics import JobTrace, MetricsServer, registry
+
+log = logging.getLogger(__name__)
+
+
+class JobWorker:
+    """
+    run_mode worker, takes jobs from the queue the ingestion process fills and writes the room messages back to
+    it, any number of workers can share one queue. Midjourney always runs in poll mode here so a job taken over
+    from a dead worker waits on the task id it already submitted
+    """
+
+    def __init__(self, config: Config):
+        logging.basicConfig(level=logging.getLevelName(config.log_level.upper()))
+        self._queue = JobQueue(config.job_queue_path, lease=config.job_lease_seconds)
+        self._job_registry = JobRegistry(config.job_registry_path, ttl=config.job_registry_ttl)
+        self._runner = JobRunner(config, self._send, midjourney_mode="poll", job_registry=self._job_registry)
+        self._concurrency = config.worker_concurrency
+        self._max_per_room = config.scheduler_max_per_room
+        self._max_per_user = config.scheduler_max_per_user
+        self._max_attempts = config.job_max_attempts
+        self._poll_interval = config.job_poll_interval
+        self._lease = config.job_lease_seconds
+        self._name = f"{socket.gethostname()}-{os.getpid()}"
+        self._running = {}
+        self._tasks = set()
+        self._metrics_server = MetricsServer(registry, host=config.metrics_host, port=config.metrics_port,
+                                             log_interval=config.metrics_log_interval)
+        self.stats = {"claimed": 0, "resumed": 0, "completed": 0, "failed": 0, "abandoned": 0}
+        registry.register_stats("worker", lambda: dict(self.stats, running=len(self._running)))
+
+    def _send(self, room_id, content, mention_ids=None, job: Job = None, merge=True):
+        self._queue.say(job.job_id if job is not None else None, room_id, content, mention_ids, merge)
+        # delivery is up to the ingestion process, the job is done once its messages are in the outbox
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(True)
+        return future
+
+    async def run(self):
+        await self._runner.open()
+        await self._metrics_server.start()
+        slots = asyncio.Semaphore(self._concurrency)
+        heartbeat = asyncio.get_running_loop().create_task(self._heartbeat())
+        log.info(f"JobWorker {self._name} started, concurrency {self._concurrency}")
+        try:
+            while True:
+                await slots.acquire()
+                job = self._queue.claim(self._name, self._max_per_room, self._max_per_user)
+                if job is None:
+                    slots.release()
+                    await asyncio.sleep(self._poll_interval)
+                    continue
+                self._running[job.job_id] = job
+                self._tasks.add(asyncio.get_running_loop().create_task(self._run1(job, slots)))
+        finally:
+            heartbeat.cancel()
+            # in flight jobs stop before the http pool closes under them, their leases run out for the next worker
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self._metrics_server.stop()
+            await self._runner.shutdown()
+
+    async def _run1(self, job: Job, slots: asyncio.Semaphore):
+        self.stats["claimed"] += 1
+        trace = JobTrace()
+        finished = True
+        try:
+            if job.attempts > self._max_attempts:
+                # every worker that took it died on the way, do not let one job take the workers down for good
+                self.stats["abandoned"] += 1
+                log.error(f"JobWorker abandons job {job.job_id} after {job.attempts - 1} attempts")
+                self._runner.error_5xx(job)
+                return
+            if job.attempts > 1:
+                self.stats["resumed"] += 1
+                log.info(f"JobWorker resumes job {job.job_id}, task_id {job.task_id}")
+            await self._runner.run(job, trace, checkpoint=self._queue.checkpoint)
+            self.stats["completed"] += 1
+        except asyncio.CancelledError:
+            # the worker is going down, the job keeps its lease and the next worker resumes it from its checkpoint
+            finished = False
+            log.info(f"JobWorker leaves job {job.job_id} to the next worker, task_id {job.task_id}")
+            raise
+        except:
+            self.stats["failed"] += 1
+            log.error(f"JobWorker job {job.job_id} with exception\n{traceback.format_exc()}")
+            self._runner.error_5xx(job)
+        finally:
+            if finished:
+                self._queue.finish(job)
+            self._running.pop(job.job_id, None)
+            self._tasks.discard(asyncio.current_task())
+            trace.finish()
+            slots.release()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self._lease / 3)
+            if self._running:
+                self._queue.renew(list(self._running), self._name)
+
+    def close(self):
+        self._runner.close()
+        self._job_registry.close()
+        self._queue.close()
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+from src.metrics import registry
+
+log = logging.getLogger(__name__)
+
+limit_changes_total = registry.counter("upstream_limit_changes_total", "AIMD concurrency limit changes",
+                                       labels=("endpoint", "direction"))
+
+# answers worth another try: throttled, upstream hiccups and local exceptions (600)
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504, 600)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def delay(self):
+        """
+        seconds until a token is available, 0 when one was taken
+        """
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+
+class AdaptiveLimiter:
+    """
+    client side limiter for one upstream endpoint. Concurrency follows AIMD: every success adds 1/limit, an
+    overload answer (backoff_statuses, timeouts included as 600) or an answer slower than latency_target halves
+    it (at most once per cooldown), other errors such as a bad request leave it alone. An optional shared
+    TokenBucket holds the account quota, and transient failures are retried with full-jitter backoff
+    """
+
+    def __init__(self, name, limit=8, min_limit=1, max_limit=64, bucket: TokenBucket = None, latency_target=None,
+                 retries=2, retry_statuses=TRANSIENT_STATUSES, backoff_statuses=TRANSIENT_STATUSES, backoff=1.0,
+                 backoff_max=30.0, cooldown=2.0):
+        self.name = name
+        self.limit = float(limit)
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._bucket = bucket
+        self._latency_target = latency_target
+        self._retries = retries
+        self._retry_statuses = retry_statuses
+        self._backoff_statuses = backoff_statuses
+        self._backoff = backoff
+        self._backoff_max = backoff_max
+        self._cooldown = cooldown
+        self._inflight = 0
+        self._waiters = deque()
+        self._last_decrease = 0.0
+        self._stats = {"calls": 0, "successes": 0, "errors": 0, "slow": 0, "retries": 0, "throttled": 0,
+                       "increases": 0, "decreases": 0, "last_change": 0.0}
+
+    @property
+    def stats(self):
+        return dict(self._stats, limit=int(self.limit), inflight=self._inflight, waiting=len(self._waiters))
+
+    async def call(self, request):
+        """
+        request is a coroutine function answering (status, value) like the ZhiShuYun clients
+        """
+        self._stats["calls"] += 1
+        attempt = 0
+        while True:
+            await self._acquire()
+            start = time.monotonic()
+            try:
+                result = await request()
+            finally:
+                self._release()
+            status, value = result
+            self._feedback(status, value, time.monotonic() - start)
+            if status or value not in self._retry_statuses or attempt >= self._retries:
+                return result
+            attempt += 1
+            self._stats["retries"] += 1
+            delay = random.uniform(0, min(self._backoff_max, self._backoff * 2 ** attempt))
+            log.warning(f"AdaptiveLimiter {self.name} got [{value}], retry {attempt}/{self._retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def _acquire(self):
+        if self._bucket is not None:
+            delay = self._bucket.delay()
+            if delay > 0:
+                self._stats["throttled"] += 1
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self._bucket.delay()
+        while self._inflight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+        self._inflight += 1
+
+    def _release(self):
+        self._inflight -= 1
+        self._wake()
+
+    def _wake(self):
+        # woken waiters check the limit again, waking one too many only costs a loop turn
+        for _ in range(max(0, int(self.limit) - self._inflight)):
+            if not self._waiters:
+                break
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _feedback(self, status, value, latency):
+        slow = self._latency_target is not None and latency > self._latency_target
+        if not status and value not in self._backoff_statuses:
+            # the caller's own fault, one user's bad requests must not throttle everyone else
+            self._stats["errors"] += 1
+            return
+        if status and not slow:
+            self._stats["successes"] += 1
+            before = int(self.limit)
+            self.limit = min(self._max_limit, self.limit + 1 / self.limit)
+            if int(self.limit) > before:
+                self._changed("increase")
+                self._wake()
+            return
+        self._stats["slow" if status else "errors"] += 1
+        now = time.monotonic()
+        if now - self._last_decrease < self._cooldown:
+            return
+        self._last_decrease = now
+        before = int(self.limit)
+        self.limit = max(self._min_limit, self.limit / 2)
+        if int(self.limit) < before:
+            self._changed("decrease")
+            log.warning(f"AdaptiveLimiter {self.name} limit {before} -> {int(self.limit)}")
+
+    def _changed(self, direction):
+        self._stats[f"{direction}s"] += 1
+        self._stats["last_change"] = time.time()
+        limit_changes_total.inc(endpoint=self.name, direction=direction)
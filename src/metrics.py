@@ -0,0 +1,213 @@
+import asyncio
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def status_class(status):
+    """
+    the clients answer (False, code), code is the http status or 600 for a local exception
+    """
+    if status >= 600:
+        return "600"
+    return f"{status // 100}xx"
+
+
+def _labels_text(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{_k}="{_v}"' for _k, _v in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(_l, "") for _l in self.labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels_text(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(_l, "") for _l in self.labels)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        idx = bisect.bisect_left(self.buckets, value)
+        if idx < len(self.buckets):
+            series[0][idx] += 1
+        series[1] += value
+        series[2] += 1
+
+    def percentile(self, percentile, **labels):
+        """
+        upper bound of the bucket holding the percentile, good enough for log lines
+        """
+        series = self._values.get(tuple(labels.get(_l, "") for _l in self.labels))
+        if series is None or series[2] == 0:
+            return 0.0
+        rank = series[2] * percentile / 100
+        seen = 0
+        for bound, count in zip(self.buckets, series[0]):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def series(self):
+        return list(self._values.keys())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels_text(self.labels, key, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels_text(self.labels, key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels_text(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self, prefix="mjbot"):
+        self._prefix = prefix
+        self._metrics = []
+        self._stats = []
+
+    def counter(self, name, documentation, labels=()):
+        metric = Counter(f"{self._prefix}_{name}", documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(f"{self._prefix}_{name}", documentation, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, name, getter):
+        """
+        expose every numeric value of a component's stats dict as a gauge named {prefix}_{name}_{key}
+        """
+        self._stats.append((f"{self._prefix}_{name}", getter))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, getter in self._stats:
+            for key, value in getter().items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f"# TYPE {name}_{key} gauge")
+                lines.append(f"{name}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram("stage_seconds", "Latency of each job stage", labels=("stage",))
+errors_total = registry.counter("errors_total", "Failed job stages by status class", labels=("stage", "status"))
+
+
+class JobTrace:
+    """
+    times the stages of one job into stage_seconds
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        stage_seconds.observe(seconds, stage=name)
+
+    def error(self, name, status):
+        errors_total.inc(stage=name, status=status_class(status))
+
+    def finish(self):
+        self.record("total", time.perf_counter() - self._start)
+        log.debug("job stages " + ", ".join(f"{_k} {_v:.3f}s" for _k, _v in self.stages.items()))
+
+
+class MetricsServer:
+    def __init__(self, registry: Registry, host="127.0.0.1", port=9464, log_interval=0):
+        self._registry = registry
+        self._host = host
+        self._port = port
+        self._log_interval = log_interval
+        self._runner = None
+        self._log_task = None
+
+    async def start(self):
+        if self._port:
+            from aiohttp import web
+
+            app = web.Application()
+            app.router.add_get("/metrics", self._handle)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, self._host, self._port).start()
+            log.info(f"MetricsServer listening on http://{self._host}:{self._port}/metrics")
+        if self._log_interval:
+            self._log_task = asyncio.get_running_loop().create_task(self._log_periodically())
+
+    async def stop(self):
+        if self._log_task is not None:
+            self._log_task.cancel()
+            self._log_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: "web.Request"):
+        from aiohttp import web
+
+        return web.Response(text=self._registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def _log_periodically(self):
+        while True:
+            await asyncio.sleep(self._log_interval)
+            log.info("stage latency p50/p95: " + ", ".join(
+                f"{_key[0]} {stage_seconds.percentile(50, stage=_key[0])}s/{stage_seconds.percentile(95, stage=_key[0])}s"
+                for _key in stage_seconds.series()))
+            log.debug(f"metrics\n{self._registry.render()}")
@@ -1,60 +1,128 @@
 import asyncio
-import base64
 import logging
-import random
 import time
 import traceback
 import urllib.parse
-from enum import Enum
 from typing import Optional
 
 from wechaty import Wechaty, WechatyOptions, Contact, Message, Room
-from wechaty_puppet import ScanStatus, FileBox, EventErrorPayload
+from wechaty_puppet import ScanStatus, EventErrorPayload
 
-from src import Config, id_generator, img_compress
-from src.translate import ZhiShuYunGPTTranslator
-from src.zsy_midjourney import ZhiShuYunMidjourney
+from src import Config, id_generator
+from src.command_parser import Command, CommandParser, action_commands
+from src.job_queue import JobQueue
+from src.job_registry import JobRegistry
+from src.job_runner import Job, JobRunner
+from src.metrics import JobTrace, MetricsServer, registry
+from src.room_sender import RoomSender
+from src.scheduler import PRIORITY_ACTION, PRIORITY_GENERATE, JobScheduler, SchedulerFull
 
 log = logging.getLogger(__name__)
 
 
-class Command(Enum):
-    help = "help"
-    generate = "mj"
-    upsample = "upsample"
-    variation = "variation"
-    upsample_light = "upsample_light"
-    upsample_beta = "upsample_beta"
+class MidjourneyBot(Wechaty):
+    """
+    run_mode all runs the jobs in this process, run_mode ingest only keeps the wechat connection, puts the
+    accepted jobs on the job queue for the workers and sends what they write to the outbox
+    """
 
+    def __init__(self, config: Config):
+        super().__init__(WechatyOptions(puppet=config.wechaty_puppet))
+        logging.basicConfig(level=logging.getLevelName(config.log_level.upper()))
+        self.bot_name = None
+        self._parser = None
+        self._runner = None
+        self._queue = None
+        self._outbox_task = None
+        # outbox rows handed to the room sender and not finished yet
+        self._outbox_sending = set()
+        # results outlive restarts, in a split deployment the workers register them in the same file
+        self._job_registry = JobRegistry(config.job_registry_path, ttl=config.job_registry_ttl)
+        if config.run_mode == "ingest":
+            self._queue = JobQueue(config.job_queue_path, lease=config.job_lease_seconds)
+            registry.register_stats("job_queue", lambda: self._queue.stats)
+        else:
+            self._runner = JobRunner(config, self._send, job_registry=self._job_registry)
+        registry.register_stats("job_registry", lambda: self._job_registry.stats)
+        self._max_queued = config.scheduler_max_queued
+        self._poll_interval = config.job_poll_interval
+        self._scheduler = JobScheduler(max_running=config.scheduler_max_running,
+                                       max_per_room=config.scheduler_max_per_room,
+                                       max_per_user=config.scheduler_max_per_user,
+                                       max_queued=config.scheduler_max_queued)
+        self._sender = RoomSender(rate=config.room_send_rate, burst=config.room_send_burst,
+                                  max_queued=config.room_send_max_queued, merge=config.room_send_merge)
+        self._metrics_server = MetricsServer(registry, host=config.metrics_host, port=config.metrics_port,
+                                             log_interval=config.metrics_log_interval)
+        registry.register_stats("scheduler", lambda: self._scheduler.stats)
+        registry.register_stats("room_sender", lambda: self._sender.stats)
 
-action_commands = {Command.generate, Command.upsample, Command.variation, Command.upsample_light, Command.upsample_beta}
+    async def start(self) -> None:
+        await self._metrics_server.start()
+        try:
+            await super().start()
+        finally:
+            await self._shutdown()
 
-short2command = {
-    "u": Command.upsample,
-    "v": Command.variation,
-}
+    async def stop(self) -> None:
+        try:
+            await super().stop()
+        finally:
+            await self._shutdown()
 
-command2short = {
-    Command.upsample: "u",
-    Command.variation: "v",
-}
+    async def _shutdown(self):
+        self._stop_outbox()
+        await self._metrics_server.stop()
+        await self._sender.close()
+        if self._runner is not None:
+            await self._runner.shutdown()
 
-short2comment = {
-    "u": "进行放大",
-    "v": "进行变换",
-}
+    def close(self):
+        if self._runner is not None:
+            self._runner.close()
+        if self._queue is not None:
+            self._queue.close()
+        self._job_registry.close()
 
-tip1 = "✅绘制成功"
-tip2 = "📎任务ID:"
+    def _send(self, room_id, content, mention_ids=None, job=None, merge=True):
+        return self._sender.send(self.Room.load(room_id), content, mention_ids=mention_ids, job=job, merge=merge)
 
+    def _start_outbox(self):
+        # messages the workers wrote while nobody was logged in go out now, with any an earlier run left unsent
+        if self._queue is None or self._outbox_task is not None:
+            return
+        self._queue.reset_outbox(self._outbox_sending)
+        self._outbox_task = asyncio.get_running_loop().create_task(self._pump_outbox())
 
-class MidjourneyBot(Wechaty):
-    def __init__(self, config: Config):
-        super().__init__(WechatyOptions(puppet=config.wechaty_puppet))
-        logging.basicConfig(level=logging.getLevelName(config.log_level.upper()))
-        self.bot_name = None
-        self._translator = ZhiShuYunGPTTranslator(config.zhishuyun_chatgpt_35_token)
-        self._midjourney = ZhiShuYunMidjourney(config.zhishuyun_midjourney_token)
+    def _stop_outbox(self):
+        if self._outbox_task is not None:
+            self._outbox_task.cancel()
+            self._outbox_task = None
+
+    async def _pump_outbox(self):
+        while True:
+            try:
+                messages = self._queue.take_outbox()
+            except:
+                log.error(f"read outbox fail\n{traceback.format_exc()}")
+                messages = []
+            for row_id, job_id, room_id, content, mention_ids, merge in messages:
+                future = self._send(room_id, content, mention_ids=mention_ids, job=job_id, merge=merge)
+                self._outbox_sending.add(row_id)
+                future.add_done_callback(lambda _future, _row_id=row_id: self._outbox_sent(_row_id, _future))
+            if not messages:
+                await asyncio.sleep(self._poll_interval)
+
+    def _outbox_sent(self, row_id, future: asyncio.Future):
+        self._outbox_sending.discard(row_id)
+        try:
+            if future.result():
+                self._queue.outbox_done(row_id)
+            elif self._outbox_task is not None:
+                self._queue.outbox_failed(row_id)
+            # once the pump stopped the row stays taken, the next login sends it again through reset_outbox
+        except:
+            log.error(f"update outbox message {row_id} fail\n{traceback.format_exc()}")
 
     async def on_scan(self, qr_code: str, status: ScanStatus, data: Optional[str] = None) -> None:
         if status == ScanStatus.Waiting and qr_code is not None:
@@ -65,11 +133,29 @@ class MidjourneyBot(Wechaty):
 
     async def on_login(self, contact: Contact) -> None:
         self.bot_name = contact.name
+        if self._runner is not None:
+            # the http clients are not needed to show the qr code, they are set up once there are messages
+            await self._runner.open()
+        self._parser = CommandParser(self.bot_name)
+        self._start_outbox()
         log.info(f"User {self.bot_name} has logged in")
 
     async def on_logout(self, contact: Contact) -> None:
         log.info(f"User {self.bot_name} has logged out")
+        self._stop_outbox()
+        self.log_stats()
         self.bot_name = None
+        self._parser = None
+
+    def log_stats(self):
+        if self._runner is not None:
+            self._runner.log_stats()
+        if self._queue is not None:
+            log.info(f"job queue stats={self._queue.stats}")
+        log.info(f"job registry stats={self._job_registry.stats}")
+        log.info(f"room sender stats={self._sender.stats}")
+        log.info(f"scheduler stats={self._scheduler.stats}, wait p50 {self._scheduler.wait_time_percentile(50):.1f}s "
+                 f"p95 {self._scheduler.wait_time_percentile(95):.1f}s")
 
     async def on_error(self, payload: EventErrorPayload) -> None:
         log.error(f"Got error with [{type(payload)}] {payload}")
@@ -78,47 +164,22 @@ class MidjourneyBot(Wechaty):
         room = msg.room()
         if room is None:
             return
-        text = msg.text().strip()
-        text, quote_from, quote_content = self.parse_quote(text)
-
-        if not text.startswith(f"@{self.bot_name}"):
+        if self._parser is None:
             return
-        command_text = text[len(self.bot_name) + 1:].strip()
-        if not command_text.startswith("/"):
+        _parse_start = time.perf_counter()
+        parsed = self._parser.parse(msg.text())
+        if parsed is None:
             return
-        command, args_text = self.split_first(command_text[1:], " ")
-        if command is None or args_text is None:
-            command = command_text[1:]
-            args_text = ""
-
-        command_idx = None
-        try:
-            command = Command(command)
-        except ValueError:
-            try:
-                command, command_idx = short2command.get(command[:-1]), int(command[-1])
-            except ValueError:
-                return
-            if command is None:
-                return
+        trace = JobTrace()
+        trace.record("parse", time.perf_counter() - _parse_start)
+        command, command_idx, args_text = parsed.command, parsed.command_idx, parsed.args_text
 
         image_id = None
-        if quote_from is not None:
-            if quote_from != self.bot_name:
-                return
-            if not quote_content.startswith("@"):
-                return
-            at_some, response = self.split_first(quote_content, " ")
-            if at_some is None or response is None or len(at_some) < 2:
-                return
-            quote_lines = response.splitlines()
-            if len(quote_lines) < 2 or not quote_lines[0].strip().startswith(tip1) or \
-                    not quote_lines[1].strip().startswith(tip2):
-                return
-            _, quote_job_id = self.split_first(quote_lines[1], ":")
-            if quote_job_id is None:
-                return
-            image_id = id_generator.decode(quote_job_id)
+        record = None
+        if parsed.quote_job_id is not None:
+            record = self._job_registry.get(parsed.quote_job_id)
+            # results from before the registry, or older than its ttl, still carry the image id in their job id
+            image_id = record.image_id if record is not None else id_generator.decode(parsed.quote_job_id)
             if image_id is None:
                 return
 
@@ -128,136 +189,89 @@ class MidjourneyBot(Wechaty):
             await self.command_help(room, from_contact)
             return
 
+        if command == Command.preview:
+            image_url = record.image_url if record is not None else parsed.quote_image_url
+            if image_id is None or command_idx not in range(1, 5) or image_url is None:
+                return
+            if record is not None and f"{Command.upsample.name}{command_idx}" not in record.actions:
+                # only a grid has tiles to preview
+                await self.error_unsupported(room, from_contact)
+                return
+            job = Job(room.room_id, from_contact.contact_id, command, command_idx, args_text, image_id,
+                      f"{command.name}{command_idx}", PRIORITY_ACTION, image_url=image_url)
+            if self._queue is not None:
+                try:
+                    self._queue.put(job, self._max_queued)
+                except SchedulerFull:
+                    await self.error_busy(room, from_contact)
+                return
+            # cropping is local work, it takes no midjourney slot and does not wait in the scheduler
+            try:
+                await self._runner.run(job, trace)
+            finally:
+                trace.finish()
+            return
+
         if command in action_commands:
             if command == Command.generate:
                 if len(args_text) == 0:
                     await self.command_help(room, from_contact)
                     return
-                await asyncio.sleep(1)
-                await room.say(f"🚀绘制任务已提交，请稍等\nPrompt: {args_text}", mention_ids=[from_contact.contact_id])
+                submitted_tip = f"🚀绘制任务已提交，请稍等\nPrompt: {args_text}"
                 action_str = command.name
             else:
                 if image_id is None or command_idx is None:
                     return
-                await asyncio.sleep(1)
-                await room.say(f"🚀绘制任务已提交，请稍等\nReal Command: /{command.value}{command_idx}",
-                               mention_ids=[from_contact.contact_id])
+                submitted_tip = f"🚀绘制任务已提交，请稍等\nReal Command: /{command.value}{command_idx}"
                 action_str = f"{command.name}{command_idx}"
-            _start = time.time()
-            translated = None
-            if command == Command.generate:
-                status, translated = await self._translator.run1(args_text)
-                if not status:
-                    if 400 <= translated < 500:
-                        await self.error_4xx(room, from_contact)
-                        return
-                    if 500 <= translated:
-                        await self.error_5xx(room, from_contact)
-                        return
+                if record is not None and action_str not in record.actions:
+                    # would only cost an upstream call that fails
+                    await self.error_unsupported(room, from_contact)
                     return
-                log.info(f"Translated from [{args_text}] 2 [{translated}]")
-                if time.time() - _start > 8:
-                    await room.say("⏳仍在继续生成中...", mention_ids=[from_contact.contact_id])
-            status, response = await self._midjourney.run1(action_str, translated, image_id)
-            if not status:
-                if 400 <= response < 500:
-                    await self.error_4xx(room, from_contact)
-                    return
-                if 500 <= response:
-                    await self.error_5xx(room, from_contact)
+            priority = PRIORITY_GENERATE if command == Command.generate else PRIORITY_ACTION
+            job = Job(room.room_id, from_contact.contact_id, command, command_idx, args_text, image_id, action_str,
+                      priority)
+            if self._queue is not None:
+                try:
+                    self._queue.put(job, self._max_queued)
+                except SchedulerFull:
+                    await self.error_busy(room, from_contact)
                     return
+                self._sender.send(room, submitted_tip, mention_ids=[from_contact.contact_id], job=job.job_id)
+                position = self._queue.position(job.job_id)
+                if position > 0:
+                    self._sender.send(room, f"⏳当前排队第{position}位，请稍等", mention_ids=[from_contact.contact_id],
+                                      job=job.job_id)
+                return
+            try:
+                ticket = self._scheduler.submit(room.room_id, from_contact.contact_id, priority)
+            except SchedulerFull:
+                await self.error_busy(room, from_contact)
                 return
-            _end = time.time()
-            await room.say("⏳生成结束，正在下载、压缩、上传图片...", mention_ids=[from_contact.contact_id])
-            await self.send_image(response, room)
-            job_id = id_generator.encode(str(response['image_id']))
+            # translation does not hold a drawing slot, it runs while the job waits in the queue
+            translating = None
             if command == Command.generate:
-                await room.say(
-                    f"{tip1}（{int(_end - _start)}秒）\n{tip2} {job_id}\n原图片地址: {response['image_url']}\nPrompt: {args_text}\nReal Prompt: {translated}\n\n{self.parse_commands(response['actions'], job_id)}",
-                    mention_ids=[from_contact.contact_id])
-            else:
-                await room.say(
-                    f"{tip1}（{int(_end - _start)}秒）\n{tip2} {job_id}\n原图片地址: {response['image_url']}\nReal Command: /{command.value}{command_idx}\n\n{self.parse_commands(response['actions'], job_id)}",
-                    mention_ids=[from_contact.contact_id])
-
-    @staticmethod
-    async def send_image(response, room: Room):
-        try:
-            pic_bytes = await img_compress.compress_from_url1(response["image_url"])
-            fb = FileBox.from_base64(base64=base64.b64encode(pic_bytes), name="IMAGE.png")
-            await room.say(fb)
-        except:
-            log.error(f"send image fail\n{traceback.format_exc()}")
-            await room.say(f"⭕图片下载失败，请直接访问原链接: {response['image_url']}")
-
-    @staticmethod
-    async def command_help(room: Room, from_contact: Contact):
-        await room.say(f"💡@ 我并输入 {Command.generate.value} 命令生成图片，如：\n/{Command.generate.value} 一只白猫",
-                       mention_ids=[from_contact.contact_id])
-
-    @staticmethod
-    async def error_4xx(room: Room, from_contact: Contact):
-        await room.say(f"⭕当前服务配置不正确，请联系管理员处理", mention_ids=[from_contact.contact_id])
-
-    @staticmethod
-    async def error_5xx(room: Room, from_contact: Contact):
-        await room.say(f"⭕Midjourney未正确返回结果或超时，请重试或联系管理员处理", mention_ids=[from_contact.contact_id])
-
-    @staticmethod
-    def parse_commands(actions, job_id):
-        all_shorts = set()
-        command_count = dict()
-        for action in actions:
-            if len(action) < 2:
-                continue
+                translating = asyncio.ensure_future(self._runner.translate1(args_text, trace))
             try:
-                command, idx = Command(action[:-1]), int(action[-1])
-            except ValueError:
-                continue
-            if command not in command2short:
-                continue
-            all_shorts.add(command2short[command])
-            if command not in command_count:
-                command_count[command2short[command]] = set()
-            command_count[command2short[command]].add(idx)
-        if len(all_shorts) == 0:
-            return ""
-        tips = "💡继续生成图片, @ 我并**引用**此消息，支持以下命令:\n"
-        for sc in all_shorts:
-            tips += "- /%s{图片编号} %s\n" % (sc, short2comment[sc])
-        tips += "例如:\n"
-        for cmd, idxs in command_count.items():
-            tips += f"/{cmd}{random.choice(list(idxs))}\n"
-        return tips.strip()
+                self._sender.send(room, submitted_tip, mention_ids=[from_contact.contact_id], job=job)
+                position = self._scheduler.position(ticket)
+                if position > 0:
+                    self._sender.send(room, f"⏳当前排队第{position}位，请稍等", mention_ids=[from_contact.contact_id],
+                                      job=job)
+                with trace.stage("queue_wait"):
+                    await self._scheduler.wait(ticket)
+                await self._runner.run(job, trace, translating)
+            finally:
+                self._scheduler.release(ticket)
+                trace.finish()
+
+    async def command_help(self, room: Room, from_contact: Contact):
+        self._sender.send(room, f"💡@ 我并输入 {Command.generate.value} 命令生成图片，如：\n/{Command.generate.value} 一只白猫",
+                          mention_ids=[from_contact.contact_id])
 
-    @staticmethod
-    def parse_quote(text: str):
-        quote_all, left = MidjourneyBot.split_first(text, "\n- -")
-        if quote_all is None or left is None:
-            return text, None, None
-        left, new_text = MidjourneyBot.split_first(left, "- -\n")
-        if left is None or new_text is None:
-            return text, None, None
-        if len(left) > 0:
-            for ci, cc in enumerate(left):
-                if ci % 2 == 0:
-                    if cc != "-":
-                        return text, None, None
-                else:
-                    if cc != " ":
-                        return text, None, None
-        if quote_all.startswith('"') or quote_all.startswith("「"):
-            quote_all = quote_all[1:]
-        if quote_all.endswith('"') or quote_all.endswith("」"):
-            quote_all = quote_all[:-1]
-        quote_from, quote_context = MidjourneyBot.split_first(quote_all.replace("：", ":"), ":")
-        if quote_from is None or quote_context is None:
-            return text, None, None
-        return new_text, quote_from, quote_context
+    async def error_unsupported(self, room: Room, from_contact: Contact):
+        self._sender.send(room, f"⭕引用的图片不支持此命令", mention_ids=[from_contact.contact_id], merge=False)
 
-    @staticmethod
-    def split_first(text: str, s: str):
-        idx = text.find(s)
-        if idx < 0:
-            return None, None
-        return text[0:idx].strip(), text[idx + len(s):].strip()
+    async def error_busy(self, room: Room, from_contact: Contact, job=None):
+        self._sender.send(room, f"⭕当前排队任务过多，请稍后再试", mention_ids=[from_contact.contact_id], job=job,
+                          merge=False)
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import time
+import traceback
+from collections import deque
+
+from wechaty import Room
+
+from src.limiter import TokenBucket
+from src.metrics import registry, stage_seconds
+
+log = logging.getLogger(__name__)
+
+send_seconds = registry.histogram("send_seconds", "Time from queueing a room message to sending it",
+                                  labels=("kind",))
+send_dropped_total = registry.counter("send_dropped_total", "Room messages dropped because the room queue was full")
+
+# merged text stays well below what wechat accepts in one message
+MERGE_MAX_CHARS = 1500
+
+
+class _Outgoing:
+    __slots__ = ("room", "content", "mention_ids", "job", "merge", "future", "queued_at")
+
+    def __init__(self, room, content, mention_ids, job, merge, future):
+        self.room = room
+        self.content = content
+        self.mention_ids = mention_ids
+        self.job = job
+        self.merge = merge
+        self.future = future
+        self.queued_at = time.monotonic()
+
+    @property
+    def is_text(self):
+        return isinstance(self.content, str)
+
+
+class RoomSender:
+    """
+    one outbound queue per room drained by its own worker and paced by a token bucket, jobs hand their messages
+    over and keep working. Messages of one job keep their order; images go ahead of the texts of other jobs, and
+    queued texts for the same mentions are merged into one message unless they were sent with merge=False.
+    A full room queue drops merge=True texts, so anything the user must see is sent with merge=False
+    """
+
+    def __init__(self, rate=1.0, burst=3, max_queued=50, merge=True):
+        self._rate = rate
+        self._burst = burst
+        self._max_queued = max_queued
+        self._merge = merge
+        self._queues = {}
+        self._buckets = {}
+        self._workers = {}
+        self.stats = {"queued": 0, "sent": 0, "merged": 0, "failed": 0, "dropped": 0, "depth_max": 0}
+
+    def send(self, room: Room, content, mention_ids=None, job=None, merge=True) -> asyncio.Future:
+        """
+        queues content for room.say, the returned future resolves to True once it was sent and to False when
+        sending failed or the message was dropped, callers that do not care about delivery can simply drop it.
+        job is any hashable naming the job the message belongs to, messages of one job are never reordered
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queue = self._queues.get(room.room_id)
+        if queue is None:
+            queue = self._queues[room.room_id] = deque()
+        item = _Outgoing(room, content, mention_ids, job, merge and self._merge, future)
+        if len(queue) >= self._max_queued and item.is_text and item.merge:
+            # only progress notes are dropped, images, results and errors are sent with merge=False and always get
+            # through
+            self.stats["dropped"] += 1
+            send_dropped_total.inc()
+            future.set_result(False)
+            return future
+        queue.append(item)
+        self.stats["queued"] += 1
+        self.stats["depth_max"] = max(self.stats["depth_max"], len(queue))
+        if room.room_id not in self._workers:
+            self._workers[room.room_id] = loop.create_task(self._drain(room.room_id))
+        return future
+
+    async def _drain(self, room_id):
+        queue = self._queues[room_id]
+        bucket = self._buckets.get(room_id)
+        if bucket is None:
+            bucket = self._buckets[room_id] = TokenBucket(self._rate, self._burst)
+        try:
+            while queue:
+                delay = bucket.delay()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                group = self._take(queue)
+                head = group[0]
+                content = "\n\n".join(_i.content for _i in group) if len(group) > 1 else head.content
+                say_start = time.monotonic()
+                try:
+                    await head.room.say(content, mention_ids=head.mention_ids)
+                    # the round trip to wechat alone, without the time spent queued behind other messages
+                    stage_seconds.observe(time.monotonic() - say_start, stage="say" if head.is_text else "upload")
+                    self.stats["sent"] += 1
+                    self.stats["merged"] += len(group) - 1
+                    sent = True
+                except asyncio.CancelledError:
+                    # close() stops the worker, the group is resolved as not sent there
+                    queue.extendleft(reversed(group))
+                    raise
+                except:
+                    self.stats["failed"] += 1
+                    log.error(f"RoomSender send to {room_id} fail\n{traceback.format_exc()}")
+                    sent = False
+                now = time.monotonic()
+                for item in group:
+                    send_seconds.observe(now - item.queued_at, kind="text" if item.is_text else "file")
+                    if not item.future.done():
+                        item.future.set_result(sent)
+        finally:
+            self._workers.pop(room_id, None)
+            if not queue:
+                self._queues.pop(room_id, None)
+
+    @staticmethod
+    def _pick(queue):
+        # the first image whose job has nothing queued before it, otherwise the head
+        waiting = set()
+        for idx, item in enumerate(queue):
+            if not item.is_text and (item.job is None or item.job not in waiting):
+                return idx
+            if item.job is not None:
+                waiting.add(item.job)
+        return 0
+
+    def _take(self, queue):
+        idx = self._pick(queue)
+        head = queue[idx]
+        del queue[idx]
+        group = [head]
+        if not head.is_text or not head.merge:
+            return group
+        size = len(head.content)
+        waiting = set()
+        rest = deque()
+        while queue:
+            item = queue.popleft()
+            if item.is_text and item.merge and item.mention_ids == head.mention_ids and \
+                    (item.job is None or item.job not in waiting) and size + len(item.content) <= MERGE_MAX_CHARS:
+                group.append(item)
+                size += len(item.content)
+                continue
+            if item.job is not None:
+                waiting.add(item.job)
+            rest.append(item)
+        queue.extend(rest)
+        return group
+
+    async def close(self):
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        for queue in self._queues.values():
+            for item in queue:
+                if not item.future.done():
+                    item.future.set_result(False)
+        self._queues.clear()
@@ -0,0 +1,139 @@
+import asyncio
+import bisect
+import itertools
+import logging
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+PRIORITY_ACTION = 0
+PRIORITY_GENERATE = 1
+
+
+class SchedulerFull(Exception):
+    pass
+
+
+class Ticket:
+    def __init__(self, room_id, user_id, priority, seq):
+        self.room_id = room_id
+        self.user_id = user_id
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.position = 0
+        self._started = asyncio.Event()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    @property
+    def started(self):
+        return self.started_at is not None
+
+    @property
+    def wait_time(self):
+        if self.started_at is None:
+            return time.monotonic() - self.enqueued_at
+        return self.started_at - self.enqueued_at
+
+
+class JobScheduler:
+    """
+    admission control for drawing jobs, a job runs once the global, per room and per user limits allow it,
+    waiting jobs are ordered by priority (cheap upsample/variation first) and then by arrival
+    """
+
+    def __init__(self, max_running=8, max_per_room=3, max_per_user=1, max_queued=100):
+        self._max_running = max_running
+        self._max_per_room = max_per_room
+        self._max_per_user = max_per_user
+        self._max_queued = max_queued
+        self._seq = itertools.count()
+        self._waiting = []
+        self._running = 0
+        self._running_per_room = {}
+        self._running_per_user = {}
+        self._wait_times = deque(maxlen=1024)
+        self.stats = {"queued": 0, "running": 0, "submitted": 0, "started": 0, "rejected": 0, "cancelled": 0}
+
+    def submit(self, room_id, user_id, priority=PRIORITY_GENERATE) -> Ticket:
+        if len(self._waiting) >= self._max_queued:
+            self.stats["rejected"] += 1
+            raise SchedulerFull(f"{len(self._waiting)} jobs are waiting")
+        ticket = Ticket(room_id, user_id, priority, next(self._seq))
+        bisect.insort(self._waiting, ticket)
+        self.stats["submitted"] += 1
+        self._dispatch()
+        if not ticket.started:
+            ticket.position = self._waiting.index(ticket) + 1
+        return ticket
+
+    async def wait(self, ticket: Ticket):
+        try:
+            await ticket._started.wait()
+        except asyncio.CancelledError:
+            if not ticket.started:
+                self._waiting.remove(ticket)
+                self.stats["cancelled"] += 1
+                self._update_stats()
+            raise
+
+    def release(self, ticket: Ticket):
+        if not ticket.started:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                self.stats["cancelled"] += 1
+                self._update_stats()
+            return
+        self._running -= 1
+        self._decrease(self._running_per_room, ticket.room_id)
+        self._decrease(self._running_per_user, ticket.user_id)
+        self._dispatch()
+
+    def position(self, ticket: Ticket):
+        if ticket.started:
+            return 0
+        return self._waiting.index(ticket) + 1
+
+    def wait_time_percentile(self, percentile):
+        if len(self._wait_times) == 0:
+            return 0.0
+        ordered = sorted(self._wait_times)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    def _dispatch(self):
+        idx = 0
+        while idx < len(self._waiting) and self._running < self._max_running:
+            ticket = self._waiting[idx]
+            if self._running_per_room.get(ticket.room_id, 0) >= self._max_per_room or \
+                    self._running_per_user.get(ticket.user_id, 0) >= self._max_per_user:
+                idx += 1
+                continue
+            self._waiting.pop(idx)
+            self._start(ticket)
+        self._update_stats()
+
+    def _start(self, ticket: Ticket):
+        ticket.started_at = time.monotonic()
+        ticket.position = 0
+        self._running += 1
+        self._running_per_room[ticket.room_id] = self._running_per_room.get(ticket.room_id, 0) + 1
+        self._running_per_user[ticket.user_id] = self._running_per_user.get(ticket.user_id, 0) + 1
+        self._wait_times.append(ticket.wait_time)
+        self.stats["started"] += 1
+        ticket._started.set()
+
+    def _update_stats(self):
+        self.stats["queued"] = len(self._waiting)
+        self.stats["running"] = self._running
+
+    @staticmethod
+    def _decrease(counter, key):
+        count = counter.get(key, 0) - 1
+        if count <= 0:
+            counter.pop(key, None)
+        else:
+            counter[key] = count
@@ -1,74 +1,258 @@
+import asyncio
 import logging
+import re
+import time
 import traceback
-from functools import lru_cache
 
-import aiohttp
-import requests
+from src.cache import AsyncLRUCache
+from src.http_pool import HttpPool
+from src.limiter import AdaptiveLimiter
 
 log = logging.getLogger(__name__)
 
 
 class Translator:
-    def run(self, prompt):
+    async def run1(self, prompt):
         pass
 
+
+class CachedTranslator(Translator):
+    def __init__(self, translator: Translator, cache: AsyncLRUCache):
+        self._translator = translator
+        self._cache = cache
+
+    @property
+    def stats(self):
+        return self._cache.stats
+
     async def run1(self, prompt):
-        pass
+        return await self._cache.get_or_load(prompt.strip(), lambda: self._translator.run1(prompt))
+
+    def close(self):
+        self._cache.close()
+
+
+_numbered_re = re.compile(r"^[ \t]*(?P<idx>[0-9]+)[ \t]*[.、:：)）][ \t]*(?P<text>.*?)[ \t]*$", re.M)
+
+
+# the midjourney parameter tail, "--ar 16:9 --v 5", starts at the first "--" that opens a word
+_params_re = re.compile(r"(?:^|\s)(?=--[A-Za-z])")
+# letters above Latin Extended-B belong to a script that midjourney does not understand well
+_LATIN_MAX = 0x024F
+
+
+def split_params(prompt):
+    """
+    "一只猫 --ar 16:9" -> ("一只猫", "--ar 16:9")
+    """
+    matched = _params_re.search(prompt)
+    if matched is None:
+        return prompt.strip(), ""
+    return prompt[:matched.start()].strip(), prompt[matched.start():].strip()
+
+
+def is_latin(text):
+    if text.isascii():
+        return True
+    for ch in text:
+        if ord(ch) > _LATIN_MAX and ch.isalpha():
+            return False
+    return True
+
+
+class LocalFirstTranslator(Translator):
+    """
+    prompts that are already Latin-script text or only parameters go to midjourney untranslated, mixed prompts
+    only send the text before the parameter tail to the translator so "--ar 16:9" can never be rewritten
+    """
+
+    def __init__(self, translator: Translator):
+        self._translator = translator
+        self._translate_seconds = None
+        self.stats = {"prompts": 0, "params_only": 0, "latin": 0, "translated": 0, "params_protected": 0,
+                      "saved_seconds": 0.0}
+
+    async def run1(self, prompt):
+        self.stats["prompts"] += 1
+        text, params = split_params(prompt)
+        if not text or is_latin(text):
+            self.stats["latin" if text else "params_only"] += 1
+            if self._translate_seconds is not None:
+                self.stats["saved_seconds"] += self._translate_seconds
+            return True, prompt.strip()
+        self.stats["translated"] += 1
+        start = time.perf_counter()
+        status, translated = await self._translator.run1(text)
+        if status:
+            cost = time.perf_counter() - start
+            # moving average of what a translation costs, credited to every prompt that skips one
+            self._translate_seconds = cost if self._translate_seconds is None else \
+                0.9 * self._translate_seconds + 0.1 * cost
+        if not status or not params:
+            return status, translated
+        self.stats["params_protected"] += 1
+        return True, f"{translated} {params}"
+
+    def close(self):
+        self._translator.close()
+
+
+class BatchingTranslator(Translator):
+    """
+    collects the prompts arriving within window seconds (or until max_batch of them) and translates them with
+    one numbered request, a batch answer that can not be split back falls back to one request per prompt
+    """
+
+    def __init__(self, translator: "ZhiShuYunGPTTranslator", window=0.5, max_batch=8):
+        self._translator = translator
+        self._window = window
+        self._max_batch = max_batch
+        self._pending = []
+        self._timer = None
+        # the loop only holds tasks weakly, a running batch is kept here until it is done
+        self._tasks = set()
+        self.stats = {"prompts": 0, "batches": 0, "batched_prompts": 0, "singles": 0, "fallbacks": 0,
+                      "upstream_calls": 0}
+
+    async def run1(self, prompt):
+        self.stats["prompts"] += 1
+        if "\n" in prompt:
+            # a multi-line prompt would break the one-line-per-number answer
+            return await self._single1(prompt)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((prompt, future))
+        if len(self._pending) >= self._max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        if pending:
+            task = asyncio.get_running_loop().create_task(self._run_batch(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, pending):
+        try:
+            if len(pending) == 1:
+                results = [await self._single1(pending[0][0])]
+            else:
+                results = await self._batch1([_p for _p, _ in pending])
+        except:
+            log.error(f"BatchingTranslator batch with exception\n{traceback.format_exc()}")
+            results = [(False, 600)] * len(pending)
+        for (_, future), result in zip(pending, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _batch1(self, prompts):
+        self.stats["batches"] += 1
+        self.stats["batched_prompts"] += len(prompts)
+        self.stats["upstream_calls"] += 1
+        status, answers = await self._translator.run_batch1(prompts)
+        if status:
+            return [(True, _a) for _a in answers]
+        if answers is not None:
+            return [(False, answers)] * len(prompts)
+        self.stats["fallbacks"] += 1
+        return await asyncio.gather(*(self._single1(_p) for _p in prompts))
+
+    async def _single1(self, prompt):
+        self.stats["singles"] += 1
+        self.stats["upstream_calls"] += 1
+        return await self._translator.run1(prompt)
 
 
 class GPTTranslator(Translator):
     def __init__(self):
         self._gpt_prompt = """我希望你能担任英语翻译、拼写校对和修辞改进的角色。我会将翻译的结果用于如stable diffusion、midjourney等生成图片，所以请确保意思不变，但更适合此类场景。我会用任何语言和你交流，你会识别语言，将其翻译为英语并仅回答翻译的最终结果，不要写解释。我的第一句话是："{}"。请立刻翻译，不要回复其它内容。"""
 
+        self._gpt_batch_prompt = """我希望你能担任英语翻译、拼写校对和修辞改进的角色。我会将翻译的结果用于如stable diffusion、midjourney等生成图片，所以请确保意思不变，但更适合此类场景。下面每一行是一句带编号的话，它们互不相关，你会识别每句话的语言，将其翻译为英语。请按原编号逐行回答翻译的最终结果，格式为“编号. 译文”，一句一行，不要写解释，不要合并或遗漏任何一句。
+{}"""
+
     def _generate_question(self, prompt):
         return self._gpt_prompt.format(prompt)
 
+    def _generate_batch_question(self, prompts):
+        return self._gpt_batch_prompt.format("\n".join(f"{_i}. {_p}" for _i, _p in enumerate(prompts, 1)))
+
+    @staticmethod
+    def _parse_batch_answer(answer, count):
+        """
+        the numbered answers in order, None unless every number from 1 to count shows up exactly once
+        """
+        answers = {}
+        for matched in _numbered_re.finditer(answer):
+            idx = int(matched.group("idx"))
+            if idx in answers or not 1 <= idx <= count:
+                return None
+            answers[idx] = matched.group("text").strip()
+        if len(answers) != count:
+            return None
+        return [answers[_i] for _i in range(1, count + 1)]
+
 
 class ZhiShuYunGPTTranslator(GPTTranslator):
-    def __init__(self, token):
+    def __init__(self, token, http: HttpPool = None, base_url="https://api.zhishuyun.com",
+                 limiter: AdaptiveLimiter = None):
         super().__init__()
-        self._url = "https://api.zhishuyun.com/chatgpt"
-        self._session = requests.Session()
+        self._url = f"{base_url}/chatgpt"
+        self._http = http if http is not None else HttpPool()
+        self._limiter = limiter
         self._params = {"token": token}
-        self._session.params = self._params
         self._headers = {
             "accept": "application/json",
             "content-type": "application/json"
         }
-        self._session.headers.update(**self._headers)
 
     async def run1(self, prompt):
-        try:
-            async with aiohttp.ClientSession(headers=self._headers,
-                                             timeout=aiohttp.ClientTimeout(total=600)) as session:
-                async with session.post(url=self._url, params=self._params,
-                                        json={"question": self._generate_question(prompt), "stateful": False,
-                                              "timeout": 600}) as resp:
-                    resp_status_code = resp.status
-                    if resp_status_code == 200:
-                        resp_json = await resp.json()
-                        return True, self._clean_answer(resp_json["answer"])
-                    resp_text = await resp.text()
-                    log.error(f"ZhiShuYunGPTTranslator response with [{resp_status_code}] {resp_text}")
-                    return False, resp_status_code
-        except:
-            log.error(f"ZhiShuYunGPTTranslator request with exception\n{traceback.format_exc()}")
-            return False, 600
+        status, answer = await self.ask1(self._generate_question(prompt))
+        if not status:
+            return False, answer
+        return True, self._clean_answer(answer)
+
+    async def run_batch1(self, prompts):
+        """
+        translates several prompts with one numbered question, (True, answers) in the order of prompts,
+        (False, None) when the answer can not be split back, (False, status) when the request failed
+        """
+        status, answer = await self.ask1(self._generate_batch_question(prompts))
+        if not status:
+            return False, answer
+        answers = self._parse_batch_answer(answer, len(prompts))
+        if answers is None:
+            log.warning(f"ZhiShuYunGPTTranslator can not split batch answer for {len(prompts)} prompts: {answer}")
+            return False, None
+        return True, [self._clean_answer(_a) for _a in answers]
+
+    async def ask1(self, question):
+        if self._limiter is None:
+            return await self._ask1(question)
+        return await self._limiter.call(lambda: self._ask1(question))
+
+    async def _ask1(self, question):
+        import aiohttp
 
-    @lru_cache(maxsize=1024)
-    def run(self, prompt):
         try:
-            log.debug(f"ZhiShuYunGPTTranslator start: {prompt}")
-            res = self._session.post(url=self._url, json={
-                "question": self._generate_question(prompt),
-                "stateful": False,
-                "timeout": 600
-            }, timeout=600)
-            if res.status_code == 200:
-                log.debug(f"ZhiShuYunGPTTranslator success: {prompt}")
-                return True, self._clean_answer(res.json()["answer"])
-            log.error(f"ZhiShuYunGPTTranslator response with [{res.status_code}] {res.text}")
-            return False, res.status_code
+            async with self._http.session.post(url=self._url, params=self._params, headers=self._headers,
+                                               json={"question": question, "stateful": False, "timeout": 600},
+                                               timeout=aiohttp.ClientTimeout(total=600)) as resp:
+                resp_status_code = resp.status
+                if resp_status_code == 200:
+                    resp_json = await resp.json()
+                    return True, resp_json["answer"]
+                resp_text = await resp.text()
+                log.error(f"ZhiShuYunGPTTranslator response with [{resp_status_code}] {resp_text}")
+                return False, resp_status_code
+        except asyncio.CancelledError:
+            # not an upstream failure, a limiter would retry it
+            raise
         except:
             log.error(f"ZhiShuYunGPTTranslator request with exception\n{traceback.format_exc()}")
             return False, 600
@@ -1,54 +1,312 @@
+import asyncio
+import heapq
 import logging
+import time
 import traceback
+from typing import TYPE_CHECKING
 
-import aiohttp
-import requests
+from src.cache import AsyncLRUCache
+from src.http_pool import HttpPool
+from src.limiter import AdaptiveLimiter
+
+if TYPE_CHECKING:
+    from aiohttp import web
 
 log = logging.getLogger(__name__)
 
 
 class ZhiShuYunMidjourney:
-    def __init__(self, token):
-        self._url = "https://api.zhishuyun.com/midjourney/imagine"
-        self._session = requests.Session()
+    def __init__(self, token, http: HttpPool = None, base_url="https://api.zhishuyun.com", mode="blocking",
+                 callback_url=None, poll_interval=5.0, limiter: AdaptiveLimiter = None,
+                 tasks_limiter: AdaptiveLimiter = None):
+        """
+        mode blocking holds one request open until the image is done, mode poll submits the job with a
+        callback_url, which makes the upstream answer with a task id right away, and waits on the shared poller
+        """
+        if mode == "poll" and not callback_url:
+            # without it the upstream holds the submit open until the image is done and the submit times out
+            raise ValueError("midjourney poll mode needs midjourney_callback_url")
+        self._url = f"{base_url}/midjourney/imagine"
+        self._tasks_url = f"{base_url}/midjourney/tasks"
+        self._http = http if http is not None else HttpPool()
+        self._callback_url = callback_url
+        self._limiter = limiter
+        self._tasks_limiter = tasks_limiter
+        self._poller = None
+        if mode == "poll":
+            self._poller = MidjourneyPoller(self, initial_interval=poll_interval, max_interval=poll_interval * 4)
         self._params = {"token": token}
-        self._session.params = self._params
         self._headers = {
             "accept": "application/json",
             "content-type": "application/json"
         }
-        self._session.headers.update(**self._headers)
 
-    async def run1(self, action, prompt, image_id=None):
+    @property
+    def poller(self):
+        return self._poller
+
+    async def run1(self, action, prompt, image_id=None, task_id=None, on_submitted=None):
+        """
+        in poll mode a known task_id resumes waiting on an already submitted task instead of submitting again,
+        on_submitted(task_id) is awaited right after a new task was accepted upstream so callers can persist it
+        """
+        if self._poller is None:
+            return await self._post1(self._url, {"action": action, "prompt": prompt, "image_id": image_id,
+                                                 "timeout": 600}, 600, self._limiter)
+        if task_id is None:
+            status, submitted = await self.submit1(action, prompt, image_id)
+            if not status:
+                return False, submitted
+            if "task_id" not in submitted or "image_url" in submitted:
+                return True, submitted
+            task_id = submitted["task_id"]
+            if on_submitted is not None:
+                await on_submitted(task_id)
+        return await self._poller.wait(task_id)
+
+    async def submit1(self, action, prompt, image_id=None):
+        json = {"action": action, "prompt": prompt, "image_id": image_id}
+        if self._callback_url:
+            json["callback_url"] = self._callback_url
+        return await self._post1(self._url, json, 60, self._limiter)
+
+    async def retrieve1(self, task_id):
+        return await self._post1(self._tasks_url, {"id": task_id, "action": "retrieve"}, 30, self._tasks_limiter)
+
+    async def _post1(self, url, json, timeout, limiter: AdaptiveLimiter = None):
+        if limiter is None:
+            return await self._post_once1(url, json, timeout)
+        return await limiter.call(lambda: self._post_once1(url, json, timeout))
+
+    async def _post_once1(self, url, json, timeout):
+        import aiohttp
+
         try:
-            async with aiohttp.ClientSession(headers=self._headers,
-                                             timeout=aiohttp.ClientTimeout(total=600)) as session:
-                async with session.post(url=self._url, params=self._params,
-                                        json={"action": action, "prompt": prompt, "image_id": image_id,
-                                              "timeout": 600}) as resp:
-                    resp_status_code = resp.status
-                    if resp_status_code == 200:
-                        resp_json = await resp.json()
-                        return True, resp_json
-                    resp_text = await resp.text()
-                    log.error(f"ZhiShuYunMidjourney response with [{resp_status_code}] {resp_text}")
-                    return False, resp_status_code
+            async with self._http.session.post(url=url, params=self._params, headers=self._headers, json=json,
+                                               timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                resp_status_code = resp.status
+                if resp_status_code == 200:
+                    resp_json = await resp.json()
+                    return True, resp_json
+                resp_text = await resp.text()
+                log.error(f"ZhiShuYunMidjourney response with [{resp_status_code}] {resp_text}")
+                return False, resp_status_code
+        except asyncio.CancelledError:
+            # not an upstream failure, a limiter would retry it
+            raise
         except:
             log.error(f"ZhiShuYunMidjourney request with exception\n{traceback.format_exc()}")
             return False, 600
 
-    def run(self, action, prompt, image_id=None):
+
+class CachedMidjourney:
+    """
+    upsample/variation results are deterministic per (action, image_id), identical requests share one upstream
+    call and later ones are answered from the cache, fresh generates always go upstream
+    """
+
+    def __init__(self, midjourney: ZhiShuYunMidjourney, cache: AsyncLRUCache):
+        self._midjourney = midjourney
+        self._cache = cache
+
+    @property
+    def poller(self):
+        return self._midjourney.poller
+
+    @property
+    def stats(self):
+        return self._cache.stats
+
+    async def run1(self, action, prompt, image_id=None, task_id=None, on_submitted=None):
+        if image_id is None:
+            return await self._midjourney.run1(action, prompt, image_id, task_id, on_submitted)
+        return await self._cache.get_or_load(
+            (action, image_id), lambda: self._midjourney.run1(action, prompt, image_id, task_id, on_submitted))
+
+    def close(self):
+        self._cache.close()
+
+
+def task_result(task):
+    """
+    (True, response) when the task is finished, (False, status) when it failed, None while it is still running
+    """
+    response = task.get("response") or {}
+    if response.get("image_url"):
+        return True, response
+    if response.get("success") is False or task.get("error") or response.get("error"):
+        log.error(f"ZhiShuYunMidjourney task {task.get('id')} failed with {task}")
+        return False, 500
+    return None
+
+
+class _PollJob:
+    def __init__(self, task_id, future, interval, deadline):
+        self.task_id = task_id
+        self.future = future
+        self.interval = interval
+        self.deadline = deadline
+        self.polling = False
+
+
+class MidjourneyPoller:
+    """
+    one timer task multiplexes every outstanding task id, each job is polled on its own schedule which backs off
+    from initial_interval to max_interval, a callback delivered through resolve() finishes a job early
+    """
+
+    def __init__(self, client: ZhiShuYunMidjourney, initial_interval=5.0, max_interval=20.0, backoff=1.5,
+                 timeout=600):
+        self._client = client
+        self._initial_interval = initial_interval
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self._timeout = timeout
+        self._jobs = {}
+        self._timers = []
+        self._wakeup = None
+        self._task = None
+        # the loop only holds tasks weakly, running polls are kept here until they are done
+        self._polls = set()
+        self.stats = {"outstanding": 0, "polls": 0, "poll_errors": 0, "completed": 0, "failed": 0, "timeouts": 0,
+                      "callbacks": 0}
+
+    async def wait(self, task_id):
+        job = self._jobs.get(task_id)
+        if job is None:
+            now = time.monotonic()
+            job = _PollJob(task_id, asyncio.get_running_loop().create_future(), self._initial_interval,
+                           now + self._timeout)
+            self._jobs[task_id] = job
+            self.stats["outstanding"] = len(self._jobs)
+            heapq.heappush(self._timers, (now + job.interval, task_id))
+            self._ensure_running()
+        return await asyncio.shield(job.future)
+
+    def resolve(self, task_id, task):
+        job = self._jobs.get(task_id)
+        if job is None:
+            return False
+        result = task_result(task)
+        if result is None:
+            return False
+        self.stats["callbacks"] += 1
+        self._finish(job, result)
+        return True
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for poll in list(self._polls):
+            poll.cancel()
+        for job in list(self._jobs.values()):
+            self._finish(job, (False, 600))
+
+    def _ensure_running(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._wakeup.set()
+
+    async def _run(self):
+        while self._jobs:
+            self._wakeup.clear()
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                _, task_id = heapq.heappop(self._timers)
+                job = self._jobs.get(task_id)
+                if job is None or job.polling:
+                    continue
+                if now > job.deadline:
+                    self.stats["timeouts"] += 1
+                    log.error(f"ZhiShuYunMidjourney task {task_id} timeout after {self._timeout}s")
+                    self._finish(job, (False, 600))
+                    continue
+                job.polling = True
+                poll = asyncio.get_running_loop().create_task(self._poll(job))
+                self._polls.add(poll)
+                poll.add_done_callback(self._polls.discard)
+            delay = self._timers[0][0] - now if self._timers else self._initial_interval
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, delay))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self, job: _PollJob):
         try:
-            res = self._session.post(url=self._url, json={
-                "action": action,
-                "prompt": prompt,
-                "image_id": image_id,
-                "timeout": 600
-            }, timeout=600)
-            if res.status_code == 200:
-                return True, res.json()
-            log.error(f"ZhiShuYunMidjourney response with [{res.status_code}] {res.text}")
-            return False, res.status_code
+            self.stats["polls"] += 1
+            status, task = await self._client.retrieve1(job.task_id)
+            if job.future.done():
+                return
+            if status:
+                result = task_result(task)
+                if result is not None:
+                    self._finish(job, result)
+                    return
+            else:
+                # a failed poll does not lose the job, the task keeps running upstream
+                self.stats["poll_errors"] += 1
+        except asyncio.CancelledError:
+            raise
         except:
-            log.error(f"ZhiShuYunMidjourney request with exception\n{traceback.format_exc()}")
-            return False, 600
+            self.stats["poll_errors"] += 1
+            log.error(f"ZhiShuYunMidjourney poll {job.task_id} with exception\n{traceback.format_exc()}")
+        finally:
+            job.polling = False
+            # whatever went wrong, an unfinished job is polled again
+            if not job.future.done():
+                job.interval = min(self._max_interval, job.interval * self._backoff)
+                heapq.heappush(self._timers, (time.monotonic() + job.interval, job.task_id))
+                self._wakeup.set()
+
+    def _finish(self, job: _PollJob, result):
+        self._jobs.pop(job.task_id, None)
+        self.stats["outstanding"] = len(self._jobs)
+        if job.future.done():
+            return
+        self.stats["completed" if result[0] else "failed"] += 1
+        job.future.set_result(result)
+
+
+class MidjourneyCallbackServer:
+    """
+    receives the upstream callback_url posts and hands them to the poller
+    """
+
+    def __init__(self, poller: MidjourneyPoller, host="0.0.0.0", port=8081, path="/midjourney/callback"):
+        self._poller = poller
+        self._host = host
+        self._port = port
+        self._path = path
+        self._runner = None
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post(self._path, self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+        log.info(f"MidjourneyCallbackServer listening on {self._host}:{self._port}{self._path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: "web.Request"):
+        from aiohttp import web
+
+        try:
+            task = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        task_id = task.get("task_id") or task.get("id") or (task.get("response") or {}).get("task_id")
+        if task_id is not None:
+            if "response" not in task:
+                task = {"id": task_id, "response": task}
+            self._poller.resolve(task_id, task)
+        return web.json_response({"success": True})